@@ -0,0 +1,122 @@
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+class BookSide:
+    """One side (buy or sell) of the order book.
+
+    Prices are kept sorted (ascending) in self.prices. Each price maps to a
+    level: a FIFO queue of resting orders keyed by order id, so the oldest
+    order at a price is always first and any order can be unlinked without
+    shifting the rest of the queue. self.sizes holds the total remaining size
+    of each level (level 2 view). Resting order sizes must only be changed
+    with reduce() so it stays exact.
+    """
+    def __init__(self, side: str):
+        self.side = side
+        self.prices = []  # type: List[Any]
+        self.levels = {}  # type: Dict[Any, OrderedDict]
+        self.sizes = {}  # type: Dict[Any, int]
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self) -> Iterator[Any]:
+        """Iterate orders from the best price outwards, FIFO within a level"""
+        for price in self.iter_prices():
+            yield from list(self.levels[price].values())
+
+    @property
+    def best(self):
+        """Best price on this side: highest buy or lowest sell"""
+        if not self.prices:
+            return None
+        if self.side == 'buy':
+            return self.prices[-1]
+        return self.prices[0]
+
+    def iter_prices(self) -> Iterator[Any]:
+        """Prices from best to worst. Safe to remove levels while iterating."""
+        if self.side == 'buy':
+            return iter(self.prices[::-1])
+        return iter(list(self.prices))
+
+    def level(self, price) -> Optional[OrderedDict]:
+        return self.levels.get(price)
+
+    def depth(self) -> List[Tuple[Any, int]]:
+        """[(price, total size), ...] from best to worst"""
+        return [(price, self.sizes[price]) for price in self.iter_prices()]
+
+    def add(self, order) -> int:
+        """Add a resting order. Returns the new size of its level."""
+        price = order.price
+        level = self.levels.get(price)
+        if level is None:
+            level = self.levels[price] = OrderedDict()
+            self.sizes[price] = 0
+            insort(self.prices, price)
+        level[order.id] = order
+        self.count += 1
+        self.sizes[price] += order.size
+        return self.sizes[price]
+
+    def reduce(self, order, size: int) -> int:
+        """Take size off a resting order (a fill). Returns the new size of
+        its level.
+        """
+        order.size -= size
+        self.sizes[order.price] -= size
+        return self.sizes[order.price]
+
+    def remove(self, order) -> Optional[int]:
+        """Remove a resting order with whatever size it has left. Returns the
+        new size of its level (0 if the level is gone), or None if the order
+        was not in the book.
+        """
+        price = order.price
+        level = self.levels.get(price)
+        if level is None or level.pop(order.id, None) is None:
+            return None
+        self.count -= 1
+        if not level:
+            del self.levels[price]
+            del self.sizes[price]
+            del self.prices[bisect_left(self.prices, price)]
+            return 0
+        self.sizes[price] -= order.size
+        return self.sizes[price]
+
+class OrderBook:
+    """Maker (limit) order book with sorted price levels on each side.
+
+    Indexing by side name (book['buy'], book['sell']) returns the BookSide.
+    """
+    def __init__(self):
+        self.buy = BookSide('buy')
+        self.sell = BookSide('sell')
+
+    def __getitem__(self, side: str) -> BookSide:
+        if side == 'buy':
+            return self.buy
+        if side == 'sell':
+            return self.sell
+        raise KeyError(side)
+
+    @property
+    def best_bid(self):
+        return self.buy.best
+
+    @property
+    def best_ask(self):
+        return self.sell.best
+
+    def add(self, order) -> int:
+        return self[order.side].add(order)
+
+    def reduce(self, order, size: int) -> int:
+        return self[order.side].reduce(order, size)
+
+    def remove(self, order) -> Optional[int]:
+        return self[order.side].remove(order)
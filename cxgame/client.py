@@ -9,8 +9,12 @@ import ssl
 import queue
 import json
 import pickle
+import itertools
+from collections import deque
+from decimal import Decimal
 from pprint import pprint
 from .util import *
+from . import wire
 
 class Response:
     def __init__(self, status=False, msg=None, data=None, raw=None):
@@ -28,43 +32,165 @@ class Response:
         return self.__str__()
 
 class CxClient:
-    def __init__(self, user=None, websocket=None, token=None, uri=None):
+    def __init__(self, user=None, websocket=None, token=None, uri=None,
+            binary=False):
         """
         Note: if a websocket is specified, this is an existing connection.
         Specifying a websocket is like the runcmd() method, but you're in
         control of the socket. If you call r() or runcmd(), they will replace
         self.websocket.
+
+        binary=True makes r()/runcmd() connect with the binary wire format
+        (see cxgame/wire.py). For your own websocket, connect with
+        subprotocols=[wire.SUBPROTOCOL]. On a binary connection prices and USD
+        in responses are integer cents and crypto is integer 1e-10 units.
         """
         self.user = user
         self.token = token
         self.websocket = websocket
         self.uri = uri
+        self.binary = binary
+        # Pipelining state, see start_pipeline()
+        self._req_ids = itertools.count(1)
+        self._pending = {}
+        self._reader_task = None
+        # Persistent connection used by r(), see connect()
+        self.reconnect_tries = 5
+        self.reconnect_delay = 0.25
+        self.reconnect_max_delay = 5.0
+        self._authed = None
+        self._loop = None
+        self._thread = None
+
+    @property
+    def is_binary(self):
+        """True if the current connection uses the binary wire format"""
+        return getattr(self.websocket, 'subprotocol', None) == wire.SUBPROTOCOL
+
+    def _usd(self, value, binary=None):
+        """USD param: Cents on binary connections, else a decimal string.
+        Cents values are accepted in both cases.
+        """
+        if binary is None:
+            binary = self.is_binary
+        if binary:
+            return Cents(to_cents(value))
+        if isinstance(value, Cents):
+            value = from_cents(value)
+        return dec_str(dec(value, prec=ROUND_USD))
+
+    def _crypto(self, value, binary=None):
+        """Crypto param: Units on binary connections, else a decimal string"""
+        if binary is None:
+            binary = self.is_binary
+        if binary:
+            return Units(to_units(value))
+        if isinstance(value, Units):
+            value = from_units(value)
+        return dec_str(dec(value, prec=ROUND_CRYPTO))
+
+    def _encode(self, msg):
+        if self.is_binary:
+            return wire.encode_command(msg)
+        return jencode(msg)
+
+    def _decode(self, x):
+        """Returns (Response, req_id)"""
+        if self.is_binary:
+            status, msg, data, req_id = wire.decode_response(x)
+            return Response(status, msg, data, x), req_id
+        j = json.loads(x)
+        response = Response(j['status'], j['message'], j['data'], x)
+        return response, j.get('req_id')
 
     async def _send_recv(self, msg):
+        if self._reader_task is not None:
+            return await self._pipelined(msg)
         response = Response()
         try:
-            await self.websocket.send(json.dumps(msg))
-            x = await self.websocket.recv()
-            j = json.loads(x)
-            response.status = j['status']
-            response.msg = j['message']
-            response.data = j['data']
-            response.raw = x
+            await self.websocket.send(self._encode(msg))
+            response = self._decode(await self.websocket.recv())[0]
         except Exception as error:
             response.status = False
             response.msg = str(error)
         return response
 
+    async def _pipelined(self, msg):
+        """Send without waiting for earlier requests. The reader task
+        resolves the future by the echoed req_id.
+        """
+        req_id = next(self._req_ids)
+        msg['req_id'] = req_id
+        future = asyncio.get_event_loop().create_future()
+        self._pending[req_id] = future
+        try:
+            await self.websocket.send(self._encode(msg))
+        except Exception as error:
+            self._pending.pop(req_id, None)
+            return Response(False, str(error))
+        return await future
+
+    async def _reader(self):
+        error = 'Connection closed.'
+        try:
+            async for x in self.websocket:
+                response, req_id = self._decode(x)
+                future = self._pending.pop(req_id, None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except Exception as err:
+            error = str(err)
+        finally:
+            self._reader_task = None
+            pending = self._pending
+            self._pending = {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_result(Response(False, error))
+
+    def start_pipeline(self):
+        """Pipeline requests on self.websocket. Commands no longer wait for
+        the previous reply before sending, so concurrent calls (e.g. with
+        asyncio.gather() or submit()) are all in flight at once. Must be
+        called from a running event loop.
+        """
+        if self._reader_task is None:
+            self._reader_task = asyncio.ensure_future(self._reader())
+
+    async def stop_pipeline(self):
+        """Go back to one request at a time. In flight requests fail."""
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+
+    def submit(self, method, *a):
+        """Start a command without waiting for it, e.g.
+        submit('buy', price, size). Returns a future for its Response. Use
+        with start_pipeline() to have many requests in flight.
+        """
+        m = getattr(self, method, None)
+        if not m:
+            raise Exception('Invalid command name: %s' % (method))
+        return asyncio.ensure_future(m(*a))
+
     async def register(self):
         msg = {'cmd': 'register', 'params': {'username': self.user}}
         response = await self._send_recv(msg)
         if response.status:
             self.token = response.data
+            # Registering also authenticates the connection
+            self._authed = (self.websocket, self.user, self.token)
         return response
 
     async def auth(self):
         msg = {'cmd': 'auth', 'params': {'username': self.user, 'token':self.token}}
-        return await self._send_recv(msg)
+        response = await self._send_recv(msg)
+        if response.status:
+            self._authed = (self.websocket, self.user, self.token)
+        return response
 
     async def shutdown(self, secret):
         """Tell the server to shutdown. Requires an admin secret"""
@@ -81,40 +207,115 @@ class CxClient:
         msg = {'cmd': 'pause', 'params': {'secret': secret}}
         return await self._send_recv(msg)
 
-    async def buy(self, price, size):
-        price = dec(price, prec=ROUND_USD)
-        size = dec(size, prec=ROUND_CRYPTO)
-        msg = {'cmd':'buy', 'params':{'price':dec_str(price), 'size':dec_str(size)}}
+    async def buy(self, price, size, client_oid=None):
+        """client_oid is an optional id of your own for the order (unique
+        per user), usable with cancel() and order() before the reply arrives.
+        The same goes for sell(), buy_market() and sell_market().
+        """
+        price = self._usd(price)
+        size = self._crypto(size)
+        msg = {'cmd':'buy', 'params':{'price':price, 'size':size}}
+        if client_oid is not None:
+            msg['params']['client_oid'] = client_oid
         return await self._send_recv(msg)
 
-    async def buy_market(self, amount):
-        amount = dec(amount, prec=ROUND_USD)
-        msg = {'cmd':'buy_market', 'params':{'amount':dec_str(amount)}}
+    async def buy_market(self, amount, client_oid=None):
+        amount = self._usd(amount)
+        msg = {'cmd':'buy_market', 'params':{'amount':amount}}
+        if client_oid is not None:
+            msg['params']['client_oid'] = client_oid
         return await self._send_recv(msg)
 
-    async def sell(self, price, size):
-        price = dec(price, prec=ROUND_USD)
-        size = dec(size, prec=ROUND_CRYPTO)
-        msg = {'cmd':'sell', 'params':{'price':dec_str(price), 'size':dec_str(size)}}
+    async def sell(self, price, size, client_oid=None):
+        price = self._usd(price)
+        size = self._crypto(size)
+        msg = {'cmd':'sell', 'params':{'price':price, 'size':size}}
+        if client_oid is not None:
+            msg['params']['client_oid'] = client_oid
         return await self._send_recv(msg)
 
-    async def sell_market(self, amount):
-        amount = dec(amount, prec=ROUND_CRYPTO)
-        msg = {'cmd':'sell_market', 'params':{'amount':dec_str(amount)}}
+    async def sell_market(self, amount, client_oid=None):
+        amount = self._crypto(amount)
+        msg = {'cmd':'sell_market', 'params':{'amount':amount}}
+        if client_oid is not None:
+            msg['params']['client_oid'] = client_oid
         return await self._send_recv(msg)
 
     async def broadcast(self, message):
         msg = {'cmd': 'bcast', 'params': {'message':message}}
         return await self._send_recv(msg)
 
-    async def cancel(self, order_id):
-        msg = {'cmd': 'cancel', 'params': {'order_id':order_id}}
+    async def cancel(self, order_id=None, client_oid=None):
+        """Cancel an order by its order_id or your client_oid"""
+        if order_id is not None:
+            params = {'order_id':order_id}
+        else:
+            params = {'client_oid':client_oid}
+        msg = {'cmd': 'cancel', 'params': params}
+        return await self._send_recv(msg)
+
+    async def order(self, order_id=None, client_oid=None):
+        """Get one of your orders by order_id (open orders) or client_oid
+        (open or completed orders)
+        """
+        if order_id is not None:
+            params = {'order_id':order_id}
+        else:
+            params = {'client_oid':client_oid}
+        msg = {'cmd': 'order', 'params': params}
+        return await self._send_recv(msg)
+
+    async def batch(self, ops):
+        """Send many order ops in one message, applied in one engine step.
+        ops is a list of tuples:
+            ('buy', price, size), ('sell', price, size),
+            ('buy_market', amount), ('sell_market', amount),
+            ('cancel', order_id)
+        Order ops can end with a client_oid, e.g. ('buy', price, size,
+        'b1'), and ('cancel', None, client_oid) cancels by client_oid.
+        The response data is a list with a {'status', 'message', 'data'}
+        result per op.
+        """
+        batch_ops = []
+        for op in ops:
+            cmd = op[0]
+            # Batches are always sent as JSON, so use decimal strings
+            if cmd in ('buy', 'sell'):
+                params = {
+                    'price':self._usd(op[1], binary=False),
+                    'size':self._crypto(op[2], binary=False),
+                }
+                client_oid = op[3] if len(op) > 3 else None
+            elif cmd == 'buy_market':
+                params = {'amount':self._usd(op[1], binary=False)}
+                client_oid = op[2] if len(op) > 2 else None
+            elif cmd == 'sell_market':
+                params = {'amount':self._crypto(op[1], binary=False)}
+                client_oid = op[2] if len(op) > 2 else None
+            elif cmd == 'cancel':
+                if op[1] is not None:
+                    params = {'order_id':op[1]}
+                else:
+                    params = {'client_oid':op[2]}
+                client_oid = None
+            else:
+                raise Exception('Invalid batch op: %s' % (cmd))
+            if client_oid is not None:
+                params['client_oid'] = client_oid
+            batch_ops.append({'cmd':cmd, 'params':params})
+        msg = {'cmd': 'batch', 'params': {'ops':batch_ops}}
+        return await self._send_recv(msg)
+
+    async def cancel_all(self):
+        """Cancel all of your open orders"""
+        msg = {'cmd': 'cancel_all', 'params': {}}
         return await self._send_recv(msg)
 
     async def price(self):
         msg = {'cmd': 'price', 'params': {}}
         response = await self._send_recv(msg)
-        response.data = dec(response.data, prec=ROUND_USD)
+        if response.status and not self.is_binary:
+            response.data = dec(response.data, prec=ROUND_USD)
         return response
 
     async def audit(self):
@@ -148,7 +349,8 @@ class CxClient:
         return username
 
     async def runcmd(self, method, *a):
-        async with websockets.connect(self.uri) as websocket:
+        subprotocols = [wire.SUBPROTOCOL] if self.binary else None
+        async with websockets.connect(self.uri, subprotocols=subprotocols) as websocket:
             self.websocket = websocket
             # Need to auth on this websocket connection every call
             if self.token and self.user:
@@ -159,9 +361,688 @@ class CxClient:
             response = await m(*a)
             return response
 
+    async def connect(self):
+        """Open self.websocket to self.uri if it is not open, retrying with
+        exponential backoff. Authenticates (if user and token are set) only
+        when the connection or credentials are new. Returns an error
+        Response if it could not connect or authenticate, else None.
+        """
+        if self.websocket is None or self.websocket.closed:
+            subprotocols = [wire.SUBPROTOCOL] if self.binary else None
+            delay = self.reconnect_delay
+            for attempt in range(self.reconnect_tries):
+                try:
+                    self.websocket = await websockets.connect(
+                        self.uri, subprotocols=subprotocols
+                    )
+                    break
+                except Exception as error:
+                    last_error = error
+                    if attempt + 1 < self.reconnect_tries:
+                        await asyncio.sleep(delay)
+                        delay = min(delay * 2, self.reconnect_max_delay)
+            else:
+                self.websocket = None
+                return Response(False, 'Connect failed: %s' % (last_error))
+        if (self.token and self.user and
+                self._authed != (self.websocket, self.user, self.token)):
+            response = await self.auth()
+            if not response.status:
+                return response
+        return None
+
+    async def _run(self, method, *a):
+        m = getattr(self, method, None)
+        if not m:
+            raise Exception('Invalid command name: %s' % (method))
+        error = await self.connect()
+        if error is not None:
+            return error
+        # NOTE: A command is not resent if the connection drops while it is in
+        # flight (it may have been applied). The next call reconnects.
+        return await m(*a)
+
+    def _start_loop(self):
+        """Event loop thread that owns the persistent connection"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, daemon=True
+        )
+        self._thread.start()
+
     def r(self, method, *a):
+        """Run a command and wait for the response. Uses one persistent
+        connection (on a background event loop thread), which is reconnected
+        and re-authenticated as needed.
+        """
         if 'reset' == method.strip():
             self.random_username()
             return True
-        return asyncio.get_event_loop().run_until_complete(self.runcmd(method, *a))
+        self._start_loop()
+        return asyncio.run_coroutine_threadsafe(
+            self._run(method, *a), self._loop
+        ).result()
+
+    def close(self):
+        """Close the r() connection and stop its event loop thread"""
+        if self._thread is None:
+            return
+        if self.websocket is not None:
+            asyncio.run_coroutine_threadsafe(
+                self.websocket.close(), self._loop
+            ).result()
+            self.websocket = None
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._thread = None
+
+
+class PooledClient(CxClient):
+    """A CxClient whose requests go over a shared CxPool connection. Get one
+    with CxPool.client(). Its requests carry a session name, which the
+    exchange authenticates separately from the other users on the
+    connection. Use the async command methods, not r()/runcmd().
+    """
+    def __init__(self, link, session, user=None, token=None):
+        self.link = link
+        self.session = session
+        super().__init__(user=user, token=token, binary=link.pool.binary)
+
+    @property
+    def websocket(self):
+        """The shared connection this client's session is on"""
+        return self.link.client.websocket
+
+    @websocket.setter
+    def websocket(self, websocket):
+        # Set by CxClient.__init__. The connection belongs to the pool.
+        pass
+
+    async def _send_recv(self, msg):
+        msg['session'] = self.session
+        return await self.link.submit(self, msg)
+
+class _PoolLink:
+    """One pooled exchange connection. Requests wait in a queue per session
+    and are sent round robin, one per session at a time, so a busy bot
+    cannot starve the others on the connection.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.client = CxClient(uri=pool.uri, binary=pool.binary)
+        self.sessions = 0
+        # session -> deque of (PooledClient, msg, future)
+        self.queues = {}
+        # Sessions with queued requests, in turn order
+        self.ready = deque()
+        self.in_flight = 0
+        self.wakeup = asyncio.Event()
+        self.slot = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.task = None
+
+    def submit(self, cx, msg):
+        queue = self.queues.setdefault(cx.session, deque())
+        if not queue:
+            self.ready.append(cx.session)
+        future = asyncio.get_event_loop().create_future()
+        queue.append((cx, msg, future))
+        self.wakeup.set()
+        return future
+
+    async def connect(self):
+        """(Re)open the connection and pipeline it. Returns an error Response
+        or None.
+        """
+        async with self.lock:
+            websocket = self.client.websocket
+            if websocket is not None and not websocket.closed:
+                return None
+            # Fail whatever the old reader still holds before reusing it
+            await self.client.stop_pipeline()
+            error = await self.client.connect()
+            if error is None:
+                self.client.start_pipeline()
+            return error
+
+    async def dispatcher(self):
+        while True:
+            while not self.ready:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            while self.in_flight >= self.pool.max_in_flight:
+                self.slot.clear()
+                await self.slot.wait()
+            session = self.ready.popleft()
+            queue = self.queues[session]
+            cx, msg, future = queue.popleft()
+            if queue:
+                self.ready.append(session)
+            else:
+                del self.queues[session]
+            self.in_flight += 1
+            asyncio.ensure_future(self._send(cx, msg, future))
+
+    async def _send(self, cx, msg, future):
+        try:
+            response = await self.connect()
+            if response is None:
+                response = await self._auth(cx, msg)
+            if response is None:
+                response = await self.client._pipelined(msg)
+        except Exception as error:
+            response = Response(False, str(error))
+        finally:
+            self.in_flight -= 1
+            self.slot.set()
+        if not future.done():
+            future.set_result(response)
+
+    async def _auth(self, cx, msg):
+        """Authenticate a session again after a reconnect"""
+        if (msg['cmd'] in ('auth', 'register') or not cx.token or not cx.user
+                or cx._authed == (self.client.websocket, cx.user, cx.token)):
+            return None
+        websocket = self.client.websocket
+        response = await self.client._pipelined({
+            'cmd':'auth', 'session':cx.session,
+            'params':{'username':cx.user, 'token':cx.token},
+        })
+        if not response.status:
+            return response
+        cx._authed = (websocket, cx.user, cx.token)
+        return None
+
+class CxPool:
+    """Runs many users (e.g. bots in one process) over a few exchange
+    connections and one feed connection.
+
+        pool = CxPool('ws://localhost:8765', size=2,
+            feed_uri='ws://localhost:8766')
+        await pool.start()
+        bots = [pool.client(user='bot%d' % (i)) for i in range(50)]
+        for cx in bots:
+            await cx.register()
+        events = pool.subscribe(topics=['trades'])
+        response = await bots[0].buy('100.00', '0.1')
+
+    Each client is pinned to the least used connection. At most
+    max_in_flight requests are outstanding per connection, and requests are
+    sent fairly across the clients on it (see _PoolLink). Dropped
+    connections are reopened on the next request and each session on them
+    re-authenticated.
+
+    The feed is read once (with a CxFeedReader, so it reconnects and
+    resumes) and every event is put on the queues from subscribe() that want
+    its topic. Events are decoded once and shared by all subscribers, so
+    don't modify them. When the feed ends for good every queue gets a
+    {'type':'feed_closed', 'message':reason} event.
+    """
+    def __init__(self, uri, size=2, binary=False, max_in_flight=32,
+            feed_uri=None):
+        self.uri = uri
+        self.size = size
+        self.binary = binary
+        self.max_in_flight = max_in_flight
+        self.feed_uri = feed_uri
+        self.links = []
+        self.feed_queues = []
+        self.feed = None
+        self._feed_task = None
+        self._sessions = itertools.count(1)
 
+    async def start(self):
+        """Open the connections. Returns an error Response or None."""
+        for i in range(self.size):
+            link = _PoolLink(self)
+            error = await link.connect()
+            if error is not None:
+                return error
+            link.task = asyncio.ensure_future(link.dispatcher())
+            self.links.append(link)
+        if self.feed_uri:
+            self.feed = CxFeedReader(self.feed_uri, binary=self.binary)
+            await self.feed.start()
+            self._feed_task = asyncio.ensure_future(self._feed_reader())
+        return None
+
+    def client(self, user=None, token=None) -> PooledClient:
+        """A client for one user on the least used connection"""
+        link = min(self.links, key=lambda link: link.sessions)
+        link.sessions += 1
+        return PooledClient(
+            link, str(next(self._sessions)), user=user, token=token
+        )
+
+    def subscribe(self, topics=None, maxsize=1000) -> asyncio.Queue:
+        """A queue of feed events on topics (default: all). If the queue is
+        full the oldest event is dropped.
+        """
+        queue = asyncio.Queue(maxsize=maxsize)
+        queue.topics = set(topics) if topics else None
+        self.feed_queues.append(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.feed_queues.remove(queue)
+
+    async def _feed_reader(self):
+        error = None
+        try:
+            async for event in self.feed:
+                event = event.as_dict()
+                topic = event_topic(event.get('type'))
+                for queue in self.feed_queues:
+                    if queue.topics is None or topic in queue.topics:
+                        self._feed_put(queue, event)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            error = str(err)
+            await self.feed.close()
+        finally:
+            closed = {
+                'type':'feed_closed',
+                'message':error or self.feed.error or 'Closed.',
+            }
+            for queue in self.feed_queues:
+                self._feed_put(queue, closed)
+
+    def _feed_put(self, queue: asyncio.Queue, event: dict):
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(event)
+
+    async def close(self):
+        tasks = [link.task for link in self.links] + [self._feed_task]
+        for task in tasks:
+            if task is not None:
+                task.cancel()
+        for link in self.links:
+            await link.client.stop_pipeline()
+            if link.client.websocket is not None:
+                await link.client.websocket.close()
+        if self.feed is not None:
+            await self.feed.close()
+        self.links = []
+        self.feed = None
+        self._feed_task = None
+
+# Event message fields that are decimal strings on JSON feeds (integer cents
+# or units on binary feeds)
+NUMERIC_FIELDS = ('price', 'size', 'usd_used', 'amount', 'filled_size')
+
+def _peek_json(raw: str):
+    """(type, seq) of an encoded feed event without parsing it. The exchange
+    encodes events with type first and seq last (see CxExchange._broadcast).
+    """
+    if not raw.startswith('{"type": "'):
+        return None, None
+    event_type = raw[10:raw.find('"', 10)]
+    seq = None
+    i = raw.rfind(', "seq": ')
+    if i > 0 and raw[i + 9:-1].isdigit():
+        seq = int(raw[i + 9:-1])
+    return event_type, seq
+
+def _peek_level_json(raw: str):
+    """(side, price) of an encoded l2 event without parsing it, None if the
+    fields aren't where the exchange puts them (see records.Level).
+    """
+    i = raw.find('"side": "')
+    j = raw.find('"price": "', i)
+    if i < 0 or j < 0:
+        return None
+    i += 9
+    j += 10
+    return raw[i:raw.find('"', i)], raw[j:raw.find('"', j)]
+
+class FeedEvent:
+    """A feed event. Only the type and seq are read up front. The rest of
+    the frame is parsed the first time a field is read, and numeric fields
+    are converted (to Decimal on JSON feeds, left as integer cents/units on
+    binary feeds) only when accessed.
+
+    Subclasses list their message fields in fields (attribute -> message
+    key).
+    """
+    fields = {}
+
+    def __init__(self, event_type, seq=None, raw=None, data=None):
+        self.type = event_type
+        self.seq = seq
+        self.raw = raw
+        self._data = data
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.as_dict())
+
+    def as_dict(self) -> dict:
+        if self._data is None:
+            if isinstance(self.raw, bytes):
+                self._data = wire.decode_event(self.raw)
+            else:
+                self._data = json.loads(self.raw)
+        return self._data
+
+    @property
+    def message(self):
+        return self.as_dict().get('message')
+
+    @property
+    def conflate_key(self):
+        """Events with the same key replace each other when conflated"""
+        return self.type
+
+    def __getattr__(self, name):
+        key = self.fields.get(name)
+        if key is None:
+            raise AttributeError(name)
+        value = self.message.get(key)
+        if isinstance(value, str) and key in NUMERIC_FIELDS:
+            value = Decimal(value)
+        setattr(self, name, value)
+        return value
+
+class TradeEvent(FeedEvent):
+    """match"""
+    fields = {
+        'size':'size', 'price':'price', 'buy_id':'buy_id', 'sell_id':'sell_id'
+    }
+
+class OrderEvent(FeedEvent):
+    """buy, sell, buy_market and sell_market"""
+    fields = {key:key for key in (
+        'timestamp', 'id', 'side', 'price', 'size', 'usd_used', 'amount',
+        'status', 'filled_size', 'user', 'client_oid',
+    )}
+
+class CancelEvent(FeedEvent):
+    @property
+    def order_id(self):
+        return self.message
+
+    @property
+    def client_oid(self):
+        return self.as_dict().get('client_oid')
+
+class LevelEvent(FeedEvent):
+    """l2. l2_seq is the book's seq, not the feed seq."""
+    fields = {'l2_seq':'seq', 'side':'side', 'price':'price', 'size':'size'}
+
+    @property
+    def conflate_key(self):
+        # Peek at side and price instead of decoding the whole event. The
+        # price is kept as sent (a string or integer cents), never converted.
+        if self._data is None:
+            if isinstance(self.raw, bytes):
+                return (self.type,) + wire.peek_level(self.raw)
+            if self.raw is not None:
+                level = _peek_level_json(self.raw)
+                if level is not None:
+                    return (self.type,) + level
+        message = self.message
+        return (self.type, message['side'], message['price'])
+
+class SnapshotEvent(FeedEvent):
+    """l2_snapshot"""
+    @property
+    def l2_seq(self):
+        return self.message['seq']
+
+    @property
+    def bids(self):
+        return [(Decimal(p), Decimal(s)) for p, s in self.message['bids']]
+
+    @property
+    def asks(self):
+        return [(Decimal(p), Decimal(s)) for p, s in self.message['asks']]
+
+class PriceEvent(FeedEvent):
+    """price, the exchange's market price after it changed"""
+    @property
+    def price(self):
+        value = self.message
+        return Decimal(value) if isinstance(value, str) else value
+
+class ChatEvent(FeedEvent):
+    """bcast"""
+    @property
+    def user(self):
+        return self.as_dict().get('user')
+
+class InfoEvent(FeedEvent):
+    pass
+
+class ShutdownEvent(FeedEvent):
+    pass
+
+class CsvEvent(FeedEvent):
+    """Final holdings at the end of a game"""
+    @property
+    def csv(self):
+        return self.as_dict().get('data')
+
+EVENT_CLASSES = {
+    'match':TradeEvent,
+    'buy':OrderEvent,
+    'sell':OrderEvent,
+    'buy_market':OrderEvent,
+    'sell_market':OrderEvent,
+    'cancel':CancelEvent,
+    'l2':LevelEvent,
+    'l2_snapshot':SnapshotEvent,
+    'price':PriceEvent,
+    'bcast':ChatEvent,
+    'info':InfoEvent,
+    'shutdown':ShutdownEvent,
+    'csv':CsvEvent,
+}
+
+def make_event(event_type, seq=None, raw=None, data=None) -> FeedEvent:
+    cls = EVENT_CLASSES.get(event_type, FeedEvent)
+    return cls(event_type, seq=seq, raw=raw, data=data)
+
+FEED_POLICIES = ('block', 'drop_oldest')
+
+class CxFeedReader:
+    """Async iterator over feed events:
+
+        async for event in CxFeedReader(uri, topics=['trades']):
+            print(event.price, event.size)
+
+    topics is sent to the feed as a subscribe command, types filters event
+    types locally (without parsing the events). Events whose type is in
+    conflate replace an older buffered event with the same conflate_key (the
+    latest trade, the latest size of an l2 level), so a consumer that falls
+    behind skips to the newest state. Conflated l2 events leave gaps in the
+    l2 seq.
+
+    At most maxsize events are buffered. With policy 'block' the reader
+    stops reading the socket when the buffer is full, which pushes back on
+    the feed (see CxFeed slow_policy). With 'drop_oldest' the oldest buffered
+    event is dropped and counted in dropped. pause() and resume() stop and
+    restart reading.
+
+    If the connection drops, it is reopened (with backoff, see
+    reconnect_tries) and resumed from the last seq received. The feed
+    replies with a 'resumed' event, or 'snapshot_required' if the missed
+    events are gone. Iteration ends when the reader is closed or cannot
+    reconnect, and error then says why (None if it was closed).
+    """
+    def __init__(self, uri, topics=None, types=None, binary=False,
+            conflate=(), maxsize=1000, policy='block'):
+        if policy not in FEED_POLICIES:
+            raise ValueError('Invalid policy: %s' % (policy))
+        self.uri = uri
+        self.topics = list(topics) if topics else None
+        self.types = set(types) if types else None
+        self.binary = binary
+        self.conflate = set(conflate)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.reconnect_tries = 5
+        self.reconnect_delay = 0.25
+        self.reconnect_max_delay = 5.0
+        self.websocket = None
+        self.seq = None
+        self.dropped = 0
+        self.error = None
+        self.items = deque()
+        # conflate_key -> the newest buffered event with that key
+        self._latest = {}
+        self._ready = asyncio.Event()
+        self._space = asyncio.Event()
+        self._reading = asyncio.Event()
+        self._reading.set()
+        self._task = None
+        self.running = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> FeedEvent:
+        if self.websocket is None:
+            await self.start()
+        while True:
+            while not self.items:
+                if self._task is None:
+                    raise StopAsyncIteration
+                self._ready.clear()
+                await self._ready.wait()
+            event = self.items.popleft()
+            self._space.set()
+            if event.type in self.conflate:
+                key = event.conflate_key
+                if self._latest.get(key) is not event:
+                    # Replaced by a newer event
+                    continue
+                del self._latest[key]
+            return event
+
+    async def start(self):
+        self.running = True
+        await self._connect()
+        self._task = asyncio.ensure_future(self._reader())
+
+    async def close(self):
+        self.running = False
+        if self._task is not None:
+            self._task.cancel()
+        if self.websocket is not None:
+            await self.websocket.close()
+
+    def pause(self):
+        """Stop reading from the feed until resume()"""
+        self._reading.clear()
+
+    def resume(self):
+        self._reading.set()
+
+    async def _connect(self):
+        subprotocols = [wire.SUBPROTOCOL] if self.binary else None
+        self.websocket = await websockets.connect(
+            self.uri, subprotocols=subprotocols
+        )
+        # Always send one command: the feed holds live events until the
+        # first one, and it replays a resume before anything live
+        topics = self.topics or sorted(FEED_TOPICS)
+        if self.seq is not None:
+            await self.websocket.send(json.dumps(
+                {'cmd':'resume', 'params':{'seq':self.seq, 'topics':topics}}
+            ))
+        else:
+            await self.websocket.send(json.dumps(
+                {'cmd':'subscribe', 'params':{'topics':topics}}
+            ))
+
+    async def _reconnect(self) -> bool:
+        delay = self.reconnect_delay
+        for attempt in range(self.reconnect_tries):
+            await asyncio.sleep(delay)
+            try:
+                await self._connect()
+                return True
+            except Exception:
+                delay = min(delay * 2, self.reconnect_max_delay)
+        return False
+
+    def _events(self, x):
+        """Feed frame to events, parsing as little as possible"""
+        if isinstance(x, bytes):
+            if x[0] == wire.KIND_BATCH:
+                frames = wire.split_batch(x)
+            else:
+                frames = [x]
+            for frame in frames:
+                if frame[0] == wire.KIND_JSON:
+                    yield from self._events(frame[1:].decode('utf-8'))
+                    continue
+                event_type, seq = wire.peek_event(frame)
+                yield make_event(event_type, seq=seq, raw=frame)
+        elif x.startswith('['):
+            # Coalesced JSON events
+            for data in json.loads(x):
+                yield make_event(data.get('type'), seq=data.get('seq'),
+                    data=data)
+        else:
+            event_type, seq = _peek_json(x)
+            if event_type is None:
+                data = json.loads(x)
+                event_type, seq = data.get('type'), data.get('seq')
+                yield make_event(event_type, seq=seq, data=data)
+            else:
+                yield make_event(event_type, seq=seq, raw=x)
+
+    async def _put(self, event: FeedEvent):
+        if event.seq is not None:
+            if self.seq is not None and event.seq <= self.seq:
+                # Already received (e.g. replayed again after a resume)
+                return
+            self.seq = event.seq
+        elif event.type == 'snapshot_required':
+            # Start over from whatever the feed sends next (its seq may have
+            # restarted)
+            self.seq = None
+        if self.types is not None and event.type not in self.types:
+            return
+        if event.type in self.conflate:
+            self._latest[event.conflate_key] = event
+        while len(self.items) >= self.maxsize:
+            if self.policy == 'drop_oldest':
+                dropped = self.items.popleft()
+                if (dropped.type in self.conflate and
+                        self._latest.get(dropped.conflate_key) is dropped):
+                    del self._latest[dropped.conflate_key]
+                self.dropped += 1
+                continue
+            self._space.clear()
+            await self._space.wait()
+        self.items.append(event)
+        self._ready.set()
+
+    async def _reader(self):
+        try:
+            while self.running:
+                try:
+                    async for x in self.websocket:
+                        for event in self._events(x):
+                            await self._put(event)
+                        await self._reading.wait()
+                except websockets.ConnectionClosed:
+                    pass
+                if not self.running:
+                    break
+                if not await self._reconnect():
+                    self.error = 'Could not reconnect to the feed.'
+                    break
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            self.error = str(err)
+        finally:
+            self._task = None
+            self.running = False
+            self._ready.set()
@@ -0,0 +1,363 @@
+"""Local mirror of the exchange, kept up to date from the feed.
+
+CxMirror subscribes to a CxFeed and keeps the level 2 book, last trade,
+market price (as published by the exchange) and one user's open orders and fills, so a strategy can read
+them locally instead of calling price/all_orders/orders in a loop:
+
+    cx = CxClient(user='root', uri='ws://localhost:8765', token='123...')
+    mirror = CxMirror(cx, 'ws://localhost:8766')
+    await mirror.start()
+    while 1:
+        await mirror.changed('book')
+        print(mirror.best_bid, mirror.best_ask, mirror.market_price)
+
+Prices and sizes are kept as integer cents/units like the engine, and the
+accessors return Decimals. The book is only valid while synced is True: it
+starts from the first l2_snapshot and goes out of sync on a gap in the l2 seq
+until the next snapshot.
+
+The feed is read with a CxFeedReader, so a dropped connection is reopened and
+resumed. If the missed events are gone the own orders are loaded again and
+the book waits for the next snapshot.
+"""
+import asyncio
+from bisect import bisect_left, insort
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
+from .util import (to_cents, to_units, from_cents, from_units, div_round,
+    notional)
+from .records import Order, Match
+from .client import CxFeedReader
+
+KINDS = ('book', 'price', 'trade', 'orders', 'fills')
+
+def _cents(value) -> int:
+    # Binary feed values are already integers, JSON values are strings
+    return value if isinstance(value, int) else to_cents(value)
+
+def _units(value) -> int:
+    return value if isinstance(value, int) else to_units(value)
+
+class MirrorSide:
+    """Aggregated sizes per price on one side, prices kept sorted"""
+    def __init__(self, side: str):
+        self.side = side
+        self.prices = []  # type: List[int]
+        self.sizes = {}  # type: Dict[int, int]
+
+    def __len__(self):
+        return len(self.prices)
+
+    @property
+    def best(self) -> Optional[int]:
+        if not self.prices:
+            return None
+        if self.side == 'buy':
+            return self.prices[-1]
+        return self.prices[0]
+
+    def set(self, price: int, size: int):
+        if size:
+            if price not in self.sizes:
+                insort(self.prices, price)
+            self.sizes[price] = size
+        elif self.sizes.pop(price, None) is not None:
+            del self.prices[bisect_left(self.prices, price)]
+
+    def clear(self):
+        self.prices = []
+        self.sizes = {}
+
+    def depth(self, n=None) -> List[Tuple[int, int]]:
+        """[(price, size), ...] from best to worst"""
+        prices = self.prices[::-1] if self.side == 'buy' else self.prices
+        if n is not None:
+            prices = prices[:n]
+        return [(price, self.sizes[price]) for price in prices]
+
+class CxMirror:
+    """Companion to a CxClient that mirrors the book, trades and the
+    client's own orders and fills from the feed. See the module docstring.
+    """
+    def __init__(self, cx, feed_uri: str):
+        self.cx = cx
+        self.feed_uri = feed_uri
+        self.feed = None
+        # Why the mirror stopped, once it has
+        self.error = None
+        self.stopped = False
+        self.buy = MirrorSide('buy')
+        self.sell = MirrorSide('sell')
+        self.l2_seq = None
+        self.synced = False
+        self.last_trade = None  # type: Optional[Match]
+        self._market_price = None
+        # Own open orders by id and by client_oid, and fills
+        self.orders = {}  # type: Dict[str, Order]
+        self.client_oids = {}  # type: Dict[str, Order]
+        self.fills = []  # type: List[Match]
+        # (buy_id, sell_id) of matches already counted in the loaded orders,
+        # and ids of own orders that were already closed when loaded
+        self._loaded_matches = set()
+        self._closed_ids = set()
+        self._waiters = {}
+        self._callbacks = []
+        self._task = None
+
+    async def start(self):
+        """Connect the client (if it isn't already) and the feed, then load
+        the client's open orders and the market price. Raises if any of it
+        fails.
+        """
+        error = await self.cx.connect()
+        if error is not None:
+            raise Exception('Mirror could not connect: %s' % (error.msg))
+        self.feed = CxFeedReader(self.feed_uri,
+            topics=['book', 'trades', 'orders'], binary=self.cx.is_binary)
+        await self.feed.start()
+        try:
+            await self._load()
+        except Exception:
+            await self.feed.close()
+            raise
+        self._task = asyncio.ensure_future(self._reader())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self.feed is not None:
+            await self.feed.close()
+
+    async def _load(self):
+        """Load the market price and own open orders. Feed events received
+        meanwhile are applied afterwards, skipping the fills the loaded
+        orders already have (found in the client's fills).
+        """
+        price = await self.cx.price()
+        orders = await self.cx.orders()
+        fills = await self.cx.fills()
+        for response in (price, orders, fills):
+            if not response.status:
+                raise Exception('Mirror could not load: %s' % (response.msg))
+        self._market_price = _cents(price.data)
+        self.orders = {}
+        self.client_oids = {}
+        for data in orders.data['maker'] + orders.data['market']:
+            self._add_own(self._order(data))
+        self._loaded_matches = set()
+        self._closed_ids = set()
+        for fill in fills.data:
+            self._loaded_matches.add((fill['buy_id'], fill['sell_id']))
+            for order_id in (fill['buy_id'], fill['sell_id']):
+                if order_id not in self.orders:
+                    self._closed_ids.add(order_id)
+
+    def on_change(self, callback):
+        """Call callback(kind, event) after every change, kind being one of
+        KINDS. Callbacks run on the feed reader and must not block.
+        """
+        self._callbacks.append(callback)
+
+    def changed(self, kind: str) -> asyncio.Future:
+        """Await the next change of a kind: book, price, trade, orders or
+        fills. Raises ConnectionError once the mirror has stopped.
+        """
+        future = self._waiters.get(kind)
+        if future is None or future.done():
+            future = asyncio.get_event_loop().create_future()
+            if self.stopped:
+                future.set_exception(ConnectionError(self.error))
+            else:
+                self._waiters[kind] = future
+        return future
+
+    def _notify(self, kind: str, event):
+        future = self._waiters.pop(kind, None)
+        if future is not None and not future.done():
+            future.set_result(event)
+        for callback in self._callbacks:
+            callback(kind, event)
+
+    @property
+    def best_bid(self) -> Optional[Decimal]:
+        best = self.buy.best
+        return None if best is None else from_cents(best)
+
+    @property
+    def best_ask(self) -> Optional[Decimal]:
+        best = self.sell.best
+        return None if best is None else from_cents(best)
+
+    @property
+    def mid(self) -> Optional[Decimal]:
+        """Midpoint of the best bid and ask, None if a side is empty"""
+        if not self.buy or not self.sell:
+            return None
+        return from_cents(div_round(self.buy.best + self.sell.best, 2))
+
+    @property
+    def market_price(self) -> Optional[Decimal]:
+        """The exchange's market price, updated from its price events"""
+        if self._market_price is None:
+            return None
+        return from_cents(self._market_price)
+
+    @property
+    def last_price(self) -> Optional[Decimal]:
+        if self.last_trade is None:
+            return None
+        return from_cents(self.last_trade.price)
+
+    def level(self, side: str, price) -> Decimal:
+        """Total size resting at a price"""
+        book = self.buy if side == 'buy' else self.sell
+        return from_units(book.sizes.get(to_cents(price), 0))
+
+    def depth(self, side: str, n=None) -> List[Tuple[Decimal, Decimal]]:
+        book = self.buy if side == 'buy' else self.sell
+        return [
+            (from_cents(price), from_units(size))
+                for price, size in book.depth(n)
+        ]
+
+    def order(self, client_oid: str) -> Optional[Order]:
+        """An open order of yours by its client_oid"""
+        return self.client_oids.get(client_oid)
+
+    def _add_own(self, order: Order):
+        self.orders[order.id] = order
+        if order.client_oid is not None:
+            self.client_oids[order.client_oid] = order
+
+    def _remove_own(self, order: Order):
+        del self.orders[order.id]
+        if order.client_oid is not None:
+            self.client_oids.pop(order.client_oid, None)
+
+    def _order(self, data: dict) -> Order:
+        side = data['side']
+        amount = data.get('amount', 0)
+        amount = _cents(amount) if side == 'buy_market' else _units(amount)
+        order = Order(
+            data['timestamp'], data['id'], side, _cents(data['price']),
+            data['user'], size=_units(data.get('size', 0)),
+            usd_used=_cents(data.get('usd_used', 0)), amount=amount,
+            client_oid=data.get('client_oid'),
+        )
+        order.status = data['status']
+        order.filled_size = _units(data['filled_size'])
+        return order
+
+    async def _reader(self):
+        try:
+            async for event in self.feed:
+                if event.type == 'snapshot_required':
+                    # Missed events are gone for good: resync the book from
+                    # the next snapshot and reload own orders
+                    self.synced = False
+                    self._notify('book', None)
+                    await self._load()
+                    continue
+                self._apply(event.as_dict())
+            self.error = self.feed.error or 'Feed closed.'
+        except asyncio.CancelledError:
+            self.error = 'Mirror closed.'
+            raise
+        except Exception as err:
+            self.error = str(err)
+        finally:
+            self.synced = False
+            self.stopped = True
+            waiters = self._waiters
+            self._waiters = {}
+            for future in waiters.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(self.error))
+
+    def _apply(self, event: dict):
+        event_type = event.get('type')
+        message = event.get('message')
+        if event_type == 'l2':
+            self._apply_level(message)
+        elif event_type == 'l2_snapshot':
+            self._apply_snapshot(message)
+        elif event_type == 'price':
+            self._market_price = _cents(message)
+            self._notify('price', message)
+        elif event_type == 'match':
+            self._apply_match(message)
+        elif event_type in ('buy', 'sell', 'buy_market', 'sell_market'):
+            if (message['user'] == self.cx.user and
+                    message['id'] not in self.orders and
+                    message['id'] not in self._closed_ids):
+                order = self._order(message)
+                self._add_own(order)
+                self._notify('orders', order)
+        elif event_type == 'cancel':
+            order = self.orders.get(message)
+            if order is not None:
+                order.status = 'cancel'
+                self._remove_own(order)
+                self._notify('orders', order)
+
+    def _apply_level(self, message: dict):
+        seq = message['seq']
+        if not self.synced or seq <= self.l2_seq:
+            return
+        if seq != self.l2_seq + 1:
+            # Missed an update, wait for the next snapshot
+            self.synced = False
+            self._notify('book', None)
+            return
+        self.l2_seq = seq
+        book = self.buy if message['side'] == 'buy' else self.sell
+        book.set(_cents(message['price']), _units(message['size']))
+        self._notify('book', message)
+
+    def _apply_snapshot(self, message: dict):
+        if self.synced and message['seq'] <= self.l2_seq:
+            return
+        for book, levels in ((self.buy, message['bids']),
+                (self.sell, message['asks'])):
+            book.clear()
+            for price, size in levels:
+                book.set(_cents(price), _units(size))
+        self.l2_seq = message['seq']
+        self.synced = True
+        self._notify('book', message)
+
+    def _apply_match(self, message: dict):
+        match = Match(
+            _units(message['size']), _cents(message['price']),
+            message['buy_id'], message['sell_id'],
+        )
+        self.last_trade = match
+        self._notify('trade', match)
+        pair = (match.buy_id, match.sell_id)
+        if pair in self._loaded_matches:
+            # Already counted in the loaded orders
+            self._loaded_matches.discard(pair)
+            return
+        for order_id in (match.buy_id, match.sell_id):
+            order = self.orders.get(order_id)
+            if order is None:
+                continue
+            # Same bookkeeping as the exchange's matching
+            order.filled_size += match.size
+            if order.side == 'buy_market':
+                order.amount -= notional(match.price, match.size)
+                left = order.amount
+            elif order.side == 'sell_market':
+                order.amount -= match.size
+                left = order.amount
+            else:
+                order.size -= match.size
+                left = order.size
+            if left <= 0:
+                order.status = 'filled'
+                self._remove_own(order)
+            self._notify('orders', order)
+            # Like the exchange's fills, a self-trade is a fill on each side
+            self.fills.append(match)
+            self._notify('fills', match)
@@ -0,0 +1,137 @@
+"""Compact exchange engine records.
+
+Prices and USD values are integer cents, crypto sizes are integer 1e-10
+units (see util.to_cents/to_units). as_dict() converts a record to the JSON
+shape clients see; util.DecimalEncoder calls it, so records can be passed
+straight to cmd_fmt()/jencode().
+"""
+from .util import from_cents, from_units
+
+class Order:
+    """A maker (buy/sell) or market (buy_market/sell_market) order.
+
+    Maker orders use size (and usd_used for buys). Market orders use amount,
+    which is USD cents for buy_market and crypto units for sell_market.
+    client_oid is the optional id the client gave the order.
+    """
+    __slots__ = (
+        'timestamp', 'id', 'side', 'price', 'size', 'usd_used', 'amount',
+        'status', 'filled_size', 'user', 'client_oid',
+    )
+
+    def __init__(self, timestamp, id, side, price, user, size=0, usd_used=0,
+            amount=0, client_oid=None):
+        self.timestamp = timestamp
+        self.id = id
+        self.side = side
+        self.price = price
+        self.size = size
+        self.usd_used = usd_used
+        self.amount = amount
+        self.status = 'open' # : open, filled, cancel
+        self.filled_size = 0
+        self.user = user
+        self.client_oid = client_oid
+
+    def __repr__(self):
+        return 'Order(%r)' % (self.as_dict())
+
+    def as_dict(self) -> dict:
+        side = self.side
+        data = {'timestamp':self.timestamp, 'id':self.id}
+        if side == 'buy' or side == 'sell':
+            data['size'] = from_units(self.size)
+            if side == 'buy':
+                data['usd_used'] = from_cents(self.usd_used)
+            data['price'] = from_cents(self.price)
+        else:
+            data['price'] = from_cents(self.price)
+            if side == 'buy_market':
+                data['amount'] = from_cents(self.amount)
+            else:
+                data['amount'] = from_units(self.amount)
+        data['side'] = side
+        data['status'] = self.status
+        data['filled_size'] = from_units(self.filled_size)
+        data['user'] = self.user
+        if self.client_oid is not None:
+            data['client_oid'] = self.client_oid
+        return data
+
+class Fill:
+    """One side's record of a match"""
+    __slots__ = ('fill_id', 'filled_size', 'price', 'buy_id', 'sell_id')
+
+    def __init__(self, fill_id, filled_size, price, buy_id, sell_id):
+        self.fill_id = fill_id
+        self.filled_size = filled_size
+        self.price = price
+        self.buy_id = buy_id
+        self.sell_id = sell_id
+
+    def __repr__(self):
+        return 'Fill(%r)' % (self.as_dict())
+
+    def as_dict(self) -> dict:
+        return {
+            'fill_id':self.fill_id,
+            'filled_size':from_units(self.filled_size),
+            'price':from_cents(self.price),
+            'buy_id':self.buy_id,
+            'sell_id':self.sell_id,
+        }
+
+class Match:
+    """A match broadcast on the feed"""
+    __slots__ = ('size', 'price', 'buy_id', 'sell_id')
+
+    def __init__(self, size, price, buy_id, sell_id):
+        self.size = size
+        self.price = price
+        self.buy_id = buy_id
+        self.sell_id = sell_id
+
+    def __repr__(self):
+        return 'Match(%r)' % (self.as_dict())
+
+    def as_dict(self) -> dict:
+        return {
+            'size':from_units(self.size),
+            'price':from_cents(self.price),
+            'buy_id':self.buy_id,
+            'sell_id':self.sell_id,
+        }
+
+class Level:
+    """A level 2 book update: the new total size at a price"""
+    __slots__ = ('seq', 'side', 'price', 'size')
+
+    def __init__(self, seq, side, price, size):
+        self.seq = seq
+        self.side = side
+        self.price = price
+        self.size = size
+
+    def __repr__(self):
+        return 'Level(%r)' % (self.as_dict())
+
+    def as_dict(self) -> dict:
+        return {
+            'seq':self.seq,
+            'side':self.side,
+            'price':from_cents(self.price),
+            'size':from_units(self.size),
+        }
+
+class Wallet:
+    __slots__ = ('usd', 'crypto')
+
+    def __init__(self, usd, crypto):
+        self.usd = usd
+        self.crypto = crypto
+
+    def __repr__(self):
+        return 'Wallet(%r)' % (self.as_dict())
+
+    def as_dict(self) -> dict:
+        return {'usd':from_cents(self.usd), 'crypto':from_units(self.crypto)}
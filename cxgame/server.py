@@ -3,34 +3,253 @@ import random
 import time
 import asyncio
 import hashlib
+import itertools
 import threading
 import ssl
 import queue
 import json
+import struct
 import pickle
 import traceback
 import argparse
+import contextlib
 from pprint import pprint
 from typing import Any, Set
-from collections import deque
+from collections import deque, OrderedDict
 import websockets
 from websockets.server import WebSocketServerProtocol
 from .util import *
+from .book import OrderBook
+from .records import Order, Fill, Wallet, Match, Level
+from . import wire
+
+class FeedQueue:
+    """Hand-off of broadcast items from the exchange to the feed event loop.
+
+    put() is thread-safe and can be called from the exchange thread. Items
+    are buffered and the feed loop is woken once per burst (with
+    call_soon_threadsafe) instead of the feed polling for them. Items put
+    before the feed attaches are kept until it does.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = deque()
+        self._loop = None
+        self._queue = None
+        self._wakeup_scheduled = False
+        self._held = False
+        # topic -> number of feed clients subscribed to it
+        self.topic_counts = {topic:0 for topic in FEED_TOPICS}
+        # Set by the feed when it keeps a replay buffer (needs every event)
+        self.keep_all = False
+        # Number of feed clients using the binary wire format
+        self.binary_count = 0
+        self._seq = itertools.count(1)
+
+    def wants(self, event_type: str) -> bool:
+        """True if any feed client is subscribed to the event's topic. Lets
+        the exchange skip encoding events nobody will receive.
+        """
+        return self.keep_all or self.topic_counts[event_topic(event_type)] > 0
+
+    def next_seq(self) -> int:
+        """Feed sequence number for the next event"""
+        return next(self._seq)
+
+    def subscribe(self, topics: Set[str], count: int = 1):
+        for topic in topics:
+            self.topic_counts[topic] += count
+
+    def unsubscribe(self, topics: Set[str]):
+        self.subscribe(topics, count=-1)
+
+    def attach(self, loop: asyncio.AbstractEventLoop):
+        """Must be called from a coroutine running on the feed loop"""
+        self._queue = asyncio.Queue()
+        with self._lock:
+            self._loop = loop
+        self._drain()
+
+    def put(self, item: Any):
+        with self._lock:
+            self._pending.append(item)
+            if self._loop is None or self._wakeup_scheduled or self._held:
+                return
+            self._wakeup_scheduled = True
+            loop = self._loop
+        loop.call_soon_threadsafe(self._drain)
+
+    @contextlib.contextmanager
+    def step(self):
+        """Hold back the feed wakeup until the block is done, so all events
+        from one engine step reach the feed together (and can share a frame).
+        """
+        self._held = True
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._held = False
+                if (not self._pending or self._loop is None or
+                        self._wakeup_scheduled):
+                    return
+                self._wakeup_scheduled = True
+                loop = self._loop
+            loop.call_soon_threadsafe(self._drain)
+
+    def _drain(self):
+        with self._lock:
+            items = self._pending
+            self._pending = deque()
+            self._wakeup_scheduled = False
+        for item in items:
+            self._queue.put_nowait(item)
+
+    async def get(self) -> Any:
+        return await self._queue.get()
+
+# Feed slow consumer policies, see FeedSubscriber
+SLOW_POLICIES = ('drop_oldest', 'conflate', 'disconnect')
+
+class FeedSubscriber:
+    """A connected feed client with its own bounded outbound queue. A writer
+    task per subscriber does the sends, so a slow client never holds up the
+    others. When the queue is full the policy decides what happens:
+
+    drop_oldest -- drop the oldest queued message
+    conflate -- drop queued book updates that newer queued ones replace (see
+        _conflate), then the oldest message if it is still full
+    disconnect -- drop the client
+
+    If coalesce_ms is set, everything queued is sent as one JSON array frame
+    (or wire batch frame) instead of a frame per message, after waiting
+    coalesce_ms for more.
+
+    Nothing is sent until released is set (see CxFeed.handler), so a resume
+    sent right after connecting is replayed before any live event.
+    """
+    def __init__(self, websocket: WebSocketServerProtocol, maxsize: int,
+            policy: str, coalesce_ms: float = None):
+        self.websocket = websocket
+        self.coalesce_ms = coalesce_ms
+        self.binary = websocket.subprotocol == wire.SUBPROTOCOL
+        # New clients get every topic until they subscribe
+        self.topics = set(FEED_TOPICS)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.items = deque()
+        self.ready = asyncio.Event()
+        self.dropped = 0
+        # seq of the first and last event queued
+        self.first_seq = None
+        self.seq = None
+        self.released = asyncio.Event()
+        self.task = None
+
+    def wants(self, event_type: str) -> bool:
+        return event_topic(event_type) in self.topics
+
+    def push(self, item: tuple) -> bool:
+        """Queue a (type, message, seq, packed, key) item. False means
+        disconnect the client.
+        """
+        if len(self.items) >= self.maxsize:
+            if self.policy == 'disconnect':
+                return False
+            if self.policy == 'conflate':
+                self._conflate()
+            if len(self.items) >= self.maxsize:
+                self.items.popleft()
+                self.dropped += 1
+        self.items.append(item)
+        if item[2] is not None:
+            if self.first_seq is None:
+                self.first_seq = item[2]
+            self.seq = item[2]
+        self.ready.set()
+        return True
+
+    def _conflate(self):
+        """Drop an l2 delta if a newer one for the same level is queued, and
+        every l2 delta and snapshot older than the newest queued snapshot.
+        Trades, orders and other events are never dropped here, and what is
+        left keeps its order.
+        """
+        keep = []
+        seen = set()
+        snapshot = False
+        for item in reversed(self.items):
+            key = item[4]
+            if key is not None:
+                if snapshot or key in seen:
+                    continue
+                seen.add(key)
+                snapshot = key == 'l2_snapshot'
+            keep.append(item)
+        keep.reverse()
+        self.dropped += len(self.items) - len(keep)
+        self.items = deque(keep)
+
+    def _frame(self, item: tuple) -> Any:
+        item_type, message, seq, packed, key = item
+        if not self.binary:
+            return message
+        if packed is None:
+            # No fixed layout for this event (or encoded before any binary
+            # client connected)
+            return wire.json_frame(message)
+        return packed
+
+    async def writer(self):
+        await self.released.wait()
+        if self.coalesce_ms is not None:
+            return await self._frame_writer()
+        while True:
+            await self.ready.wait()
+            while self.items:
+                await self.websocket.send(self._frame(self.items.popleft()))
+            self.ready.clear()
+
+    async def _frame_writer(self):
+        while True:
+            await self.ready.wait()
+            if self.coalesce_ms:
+                await asyncio.sleep(self.coalesce_ms / 1000)
+            self.ready.clear()
+            frames = [self._frame(item) for item in self.items]
+            self.items = deque()
+            if self.binary:
+                await self.websocket.send(wire.batch_frame(frames))
+            else:
+                await self.websocket.send('[%s]' % (','.join(frames)))
 
 #STATE_LOCK = threading.Lock()
 STATE = {
-    'lowest_sell':dec('2000.01'),
-    'highest_buy':dec('990.99'),
-    'market_price':dec('1000.00'),
-    'spread':dec('1.00'),
-    'orders':{'buy':[], 'sell':[],},
-    'market_orders':{'buy':[], 'sell':[]},
+    # Top of book as of the last market price update (None if side is empty)
+    'lowest_sell':None,
+    'highest_buy':None,
+    # Prices and USD are integer cents, crypto is integer 1e-10 units
+    'market_price':to_cents('1000.00'),
+    'spread':to_cents('1.00'),
+    'orders':OrderBook(),
+    'market_orders':{'buy':OrderedDict(), 'sell':OrderedDict()},
+    # order id -> open order (maker and market)
+    'order_index':{},
+    # (user, client_oid) -> order. Kept for the whole game, so a client_oid
+    # can't be reused and completed orders can still be looked up by it.
+    'client_oids':{},
+    # Sequence number of the last level 2 book update
+    'l2_seq':0,
+    # Bumped on every book, trade and price change (see response_cache)
+    'version':0,
+    # user -> {order id -> open order} (maker and market)
+    'user_orders':{},
     'orders_completed': [],
     'wallets':{},
     'client_user_map':{},
     'users':{},
     'user_fills':{},
-    'queue':queue.Queue()
+    'queue':FeedQueue()
 }
 
 class CxFeed:
@@ -42,43 +261,177 @@ class CxFeed:
             port: int = 9876,
             bind: str = '0.0.0.0',
             pem_file: str = None,
-            ssl_verify: bool = True):
+            ssl_verify: bool = True,
+            send_queue_size: int = 1000,
+            slow_policy: str = 'drop_oldest',
+            replay_size: int = 10000,
+            coalesce_ms: float = None):
+        if not slow_policy in SLOW_POLICIES:
+            raise ValueError('slow_policy must be one of: %s' % (
+                ', '.join(SLOW_POLICIES)))
         self.port = port
         self.bind = bind
         self.pem_file = pem_file
         self.ssl_verify = ssl_verify
-        self.clients = set()
+        self.send_queue_size = send_queue_size
+        self.slow_policy = slow_policy
+        # None sends a frame per event, 0 a frame per engine step, > 0 also
+        # waits that many ms to batch more
+        self.coalesce_ms = coalesce_ms
+        # The last replay_size events, for clients resuming after a reconnect
+        self.replay = deque(maxlen=replay_size)
+        self.queue.keep_all = replay_size > 0
+        # websocket -> FeedSubscriber
+        self.clients = {}
+        # Seconds a new client's live events are held back waiting for its
+        # first command (e.g. resume). Clients that send none get them after.
+        self.hold_time = 0.5
         self.running = False
 
     @property
     def queue(self):
         return STATE['queue']
 
-    async def _handler(self):
-        # Only want 1 handler to broadcast to all clients
-        # Subsequent handlers sleep
-        if self.running:
-            while 1:
-                await asyncio.sleep(10)
+    async def _publisher(self):
+        """Single task that broadcasts queued items to all clients"""
+        self.queue.attach(asyncio.get_event_loop())
+        self.running = True
+        # Running can be used to shutdown feed server gracefully
+        while self.running:
+            item = await self.queue.get()
+            print('CxFeed item:', item[1], 'clients:', len(self.clients))
+            self.replay.append(item)
+            for websocket, subscriber in list(self.clients.items()):
+                if not subscriber.wants(item[0]):
+                    continue
+                if not subscriber.push(item):
+                    print('CxFeed: disconnecting slow client.')
+                    self._remove(subscriber)
+                    # The handler returns and the connection is closed
+                    subscriber.task.cancel()
+
+    def _remove(self, subscriber: FeedSubscriber):
+        if self.clients.pop(subscriber.websocket, None) is not None:
+            self.queue.unsubscribe(subscriber.topics)
+            if subscriber.binary:
+                self.queue.binary_count -= 1
+
+    def _subscribe(self, subscriber: FeedSubscriber, params: Any):
+        """Replace the client's topics. Replies on the client's own queue."""
+        topics = params.get('topics') if isinstance(params, dict) else None
+        if not isinstance(topics, list):
+            return {'type':'error', 'message':'Invalid subscribe params.'}
+        invalid = [t for t in topics if not t in FEED_TOPICS]
+        if invalid:
+            return {
+                'type':'error',
+                'message':'Invalid topics: %s' % (', '.join(map(str, invalid)))
+            }
+        topics = set(topics)
+        self.queue.unsubscribe(subscriber.topics)
+        self.queue.subscribe(topics)
+        subscriber.topics = topics
+        return {'type':'subscribed', 'message':sorted(topics)}
+
+    def _resume(self, subscriber: FeedSubscriber, params: Any):
+        """Queue the buffered events after the client's last seen seq. If
+        they are no longer all buffered, the client must take a snapshot
+        (e.g. all_orders/fills and the next l2_snapshot) and start over.
+        Optional topics are subscribed to first.
+        """
+        seq = params.get('seq') if isinstance(params, dict) else None
+        if not isinstance(seq, int):
+            return {'type':'error', 'message':'Invalid resume params.'}
+        if 'topics' in params:
+            response = self._subscribe(subscriber, params)
+            if response['type'] == 'error':
+                return response
+        if not subscriber.released.is_set():
+            # Live events queued since connecting are also in the replay
+            # buffer. Drop them and replay everything after seq in order.
+            subscriber.items = deque(
+                item for item in subscriber.items if item[2] is None
+            )
+            after = seq
         else:
-            self.running = True
-            # Running can be used to shutdown feed server gracefully
-            while self.running:
+            # Events up to the last one queued were already sent live
+            after = max(seq, subscriber.seq or seq)
+        oldest = self.replay[0][2] if self.replay else None
+        latest = self.replay[-1][2] if self.replay else None
+        snapshot_required = {'type':'snapshot_required', 'message':{
+            'seq':seq,
+            'oldest':oldest,
+            'latest':latest,
+        }}
+        if seq == latest:
+            return {'type':'resumed', 'message':{'seq':seq, 'count':0}}
+        if oldest is None or seq < oldest - 1 or seq > latest:
+            return snapshot_required
+        if (subscriber.released.is_set() and subscriber.first_seq is not None
+                and subscriber.first_seq > seq + 1):
+            # Live events after a gap were already sent, so the gap can't be
+            # filled in order
+            return snapshot_required
+        # Buffered seqs are contiguous
+        missed = [
+            item for item in itertools.islice(
+                self.replay, after + 1 - oldest, None
+            ) if subscriber.wants(item[0])
+        ]
+        # Replaying more than the client's send queue holds would just be
+        # dropped again
+        if len(missed) + len(subscriber.items) >= subscriber.maxsize:
+            return snapshot_required
+        for item in missed:
+            subscriber.push(item)
+        return {'type':'resumed', 'message':{'seq':seq, 'count':len(missed)}}
+
+    async def _reader(self, subscriber: FeedSubscriber):
+        """Read subscribe/resume commands from a client until it goes away"""
+        try:
+            async for message in subscriber.websocket:
                 try:
-                    item = self.queue.get(block=False)
+                    if isinstance(message, bytes):
+                        data = wire.decode_command(message)
+                    else:
+                        data = json.loads(message)
+                    cmd = data.get('cmd')
                 except:
-                    await asyncio.sleep(0.25)
-                    continue
-                print('CxFeed item:', item, 'clients:', len(self.clients))
-                for websocket in shuffle2(self.clients):
-                    try:
-                        await websocket.send(item)
-                    except:
-                        self.clients.remove(websocket)
+                    data, cmd = {}, None
+                if cmd == 'subscribe':
+                    response = self._subscribe(subscriber, data.get('params'))
+                elif cmd == 'resume':
+                    response = self._resume(subscriber, data.get('params'))
+                else:
+                    response = {'type':'error', 'message':'Invalid command.'}
+                subscriber.push(
+                    (response['type'], jencode(response), None, None, None)
+                )
+                subscriber.released.set()
+        except websockets.ConnectionClosed:
+            pass
 
     async def handler(self, websocket: WebSocketServerProtocol, path: str):
-        self.clients.add(websocket)
-        await self._handler()
+        subscriber = FeedSubscriber(
+            websocket, self.send_queue_size, self.slow_policy, self.coalesce_ms
+        )
+        subscriber.task = asyncio.ensure_future(subscriber.writer())
+        asyncio.get_event_loop().call_later(
+            self.hold_time, subscriber.released.set
+        )
+        self.clients[websocket] = subscriber
+        self.queue.subscribe(subscriber.topics)
+        if subscriber.binary:
+            self.queue.binary_count += 1
+        # Keep the connection open until the client goes away or the writer
+        # stops (send failed or slow client dropped)
+        reader = asyncio.ensure_future(self._reader(subscriber))
+        await asyncio.wait(
+            (subscriber.task, reader), return_when=asyncio.FIRST_COMPLETED
+        )
+        subscriber.task.cancel()
+        reader.cancel()
+        self._remove(subscriber)
 
     def start(self):
         ssl_context = None
@@ -89,8 +442,12 @@ class CxFeed:
                 ssl_context.check_hostname = False
                 ssl_context.verify_mode = ssl.CERT_NONE
         asyncio.set_event_loop(asyncio.new_event_loop())
-        start_server = websockets.serve(self.handler, self.bind, self.port, ssl=ssl_context)
+        start_server = websockets.serve(
+            self.handler, self.bind, self.port, ssl=ssl_context,
+            subprotocols=[wire.SUBPROTOCOL]
+        )
         asyncio.get_event_loop().run_until_complete(start_server)
+        asyncio.get_event_loop().create_task(self._publisher())
         asyncio.get_event_loop().run_forever()
 
 
@@ -106,7 +463,8 @@ class CxExchange:
             pem_file: str = None,
             ssl_verify: bool = True,
             admin_secret: str = 'admin',
-            is_started: bool = True):
+            is_started: bool = True,
+            l2_snapshot_interval: float = 5.0):
         self.port = port
         self.bind = bind
         self.time_limit = time_limit
@@ -135,16 +493,34 @@ class CxExchange:
             'all_orders':self._all_orders,
             'wallets':self._wallets,
             'cancel':self._cancel,
+            'cancel_all':self._cancel_all,
             'fills':self._fills,
             'completed':self._completed,
             'audit':self._audit,
             'shutdown':self._shutdown,
             'start':self._open_for_business,
             'pause':self._pause,
+            'batch':self._batch,
+            'order':self._order,
         }
+        # Commands allowed inside a batch
+        self.batch_cmds = ('buy', 'sell', 'buy_market', 'sell_market', 'cancel')
+        self.batch_limit = 100
+        # Work put off until the end of a batch (None when not batching)
+        self.deferred = None
         self.time_start = time.time()
+        # How often (seconds) the game clock checks time_limit
+        self.clock_interval = 0.1
+        # How often (seconds) a level 2 book snapshot is broadcast
+        self.l2_snapshot_interval = l2_snapshot_interval
+        self.l2_snapshot_time = 0
         self.price_history = deque(maxlen=3)
         self.price_history.append(self.market_price)
+        # Commands that return the same global data to every user. Their
+        # encoded responses are shared until the state version changes.
+        self.cached_cmds = ('price', 'all_orders', 'completed')
+        # (cmd, format) -> (state version, encoded response)
+        self.response_cache = {}
 
     def _is_authed(self, websocket: WebSocketServerProtocol):
         exists = False
@@ -158,7 +534,27 @@ class CxExchange:
         return user
 
     def _broadcast(self, data: Any):
-        self.queue.put(jencode(data))
+        # Feed items are (event type, encoded message, seq, packed, key) where
+        # packed is the binary wire frame, only made if a feed client uses the
+        # binary format, and key says which book state the event replaces for
+        # slow clients (see FeedSubscriber._conflate). Events no feed client
+        # is subscribed to are never encoded.
+        event_type = data['type']
+        if self.queue.wants(event_type):
+            data['seq'] = self.queue.next_seq()
+            packed = None
+            if self.queue.binary_count:
+                try:
+                    packed = wire.encode_event(data)
+                except struct.error:
+                    # A value out of the layout's range, send it as JSON
+                    packed = None
+            key = None
+            if event_type == 'l2':
+                key = (data['message'].side, data['message'].price)
+            elif event_type in ('l2_snapshot', 'price'):
+                key = event_type
+            self.queue.put((event_type, jencode(data), data['seq'], packed, key))
 
     @property
     def client_user_map(self):
@@ -173,8 +569,16 @@ class CxExchange:
         return STATE['market_price']
 
     @market_price.setter
-    def market_price(self, value: Decimal):
-        STATE['market_price'] = dec(value, prec=ROUND_USD)
+    def market_price(self, value: int):
+        STATE['market_price'] = value
+
+    @property
+    def highest_buy(self):
+        return STATE['highest_buy']
+
+    @property
+    def lowest_sell(self):
+        return STATE['lowest_sell']
 
     @property
     def spread(self):
@@ -200,6 +604,14 @@ class CxExchange:
     def orders(self):
         return STATE['orders']
 
+    @property
+    def order_index(self):
+        return STATE['order_index']
+
+    @property
+    def client_oids(self):
+        return STATE['client_oids']
+
     @property
     def orders_completed(self):
         return STATE['orders_completed']
@@ -224,6 +636,10 @@ class CxExchange:
     def user_fills(self):
         return STATE['user_fills']
 
+    @property
+    def user_orders(self):
+        return STATE['user_orders']
+
     def _fills(self, websocket: WebSocketServerProtocol, params: dict):
         if not self._is_authed(websocket):
             return status_error('Must be authenticated.')
@@ -236,38 +652,39 @@ class CxExchange:
         user = self._get_user(websocket)
         if not 'size' in params or not 'price' in params:
             return status_error('Must size "price" and "size" in params.')
-        size = dec(params['size'], prec=ROUND_CRYPTO)
-        price = dec(params['price'], prec=ROUND_USD)
-        if size < MIN_SIZE:
+        size = to_units(params['size'])
+        price = to_cents(params['price'])
+        if size < MIN_SIZE_UNITS:
             return status_error(
                 'Size must be greater than or equal to %s' % (MIN_SIZE)
             )
-        if price < MIN_PRICE:
+        if price < MIN_PRICE_CENTS:
             return status_error(
                 'Price must be greater than or equal to %s' % (MIN_PRICE)
             )
+        if size > MAX_ORDER_VALUE or price > MAX_ORDER_VALUE:
+            return status_error('Price or size is too large.')
         if price < self.market_price:
             return status_error(
-                'Price must be >= market price (%s).' % (self.market_price)
+                'Price must be >= market price (%s).' % (from_cents(self.market_price))
             )
-        if size > self.wallets[user]['crypto']:
+        if size > self.wallets[user].crypto:
             return status_error('Size is > available.')
+        client_oid = params.get('client_oid')
+        error = self._check_client_oid(user, client_oid)
+        if error:
+            return error
 
         # Subtract cost from user's crypto wallet
-        self.wallets[user]['crypto'] = dec(self.wallets[user]['crypto'] - size, prec=ROUND_CRYPTO)
-        order = {
-            'timestamp':time.time(),
-            'id':user_token(),
-            'size':size,
-            'price':price,
-            'side':'sell',
-            'status':'open', # : open, filled
-            'filled_size':dec('0.00'),
-            'user':user,
-        }
-        self.orders['sell'].append(order)
-        self._calc_market_price()
+        self.wallets[user].crypto -= size
+        order = Order(time.time(), new_id(), 'sell', price, user, size=size,
+            client_oid=client_oid)
+        self._add_order(order)
+        self._index_order(order)
         self._broadcast({'type':'sell', 'message':order})
+        self._match_maker_order(order)
+        self._match_market_buys()
+        self._calc_market_price()
         return status_ok('Sell order placed.', data=order)
 
     def _buy_market(self, websocket:WebSocketServerProtocol, params:dict):
@@ -276,29 +693,31 @@ class CxExchange:
         user = self._get_user(websocket)
         if not 'amount' in params:
             return status_error('Must have "amount" in params.')
-        amount = dec(params['amount'], prec=ROUND_USD)
-        if amount < MIN_AMOUNT:
+        amount = to_cents(params['amount'])
+        if amount < MIN_AMOUNT_CENTS:
             return status_error(
                 'Amount must be greater than or equal to %s' % (MIN_AMOUNT)
             )
-        if amount > self.wallets[user]['usd']:
+        if amount > MAX_ORDER_VALUE:
+            return status_error('Amount is too large.')
+        if amount > self.wallets[user].usd:
             return status_error('Not enough USD to buy.')
 
         if len(self.orders['sell']) < 1:
             return status_error('No available sell orders to match.')
-        self.wallets[user]['usd'] = dec(self.wallets[user]['usd'] - amount, prec=ROUND_USD)
-        order = {
-            'timestamp':time.time(),
-            'id':user_token(),
-            'price':self.market_price, # Target price, not gauranteed
-            'amount':dec(amount, prec=ROUND_USD),
-            'side':'buy_market',
-            'status':'open', # : open, filled
-            'filled_size':dec('0.00'),
-            'user':user,
-        }
-        self.market_orders['buy'].append(order)
+        client_oid = params.get('client_oid')
+        error = self._check_client_oid(user, client_oid)
+        if error:
+            return error
+        self.wallets[user].usd -= amount
+        # price is the target price, not gauranteed
+        order = Order(time.time(), new_id(), 'buy_market',
+            self.market_price, user, amount=amount, client_oid=client_oid)
+        self.market_orders['buy'][order.id] = order
+        self._index_order(order)
         self._broadcast({'type':'buy_market', 'message':order})
+        self._match_market_buy(order)
+        self._calc_market_price()
         return status_ok('Market buy order placed.', data=order)
 
     def _sell_market(self, websocket:WebSocketServerProtocol, params:dict):
@@ -307,290 +726,238 @@ class CxExchange:
         user = self._get_user(websocket)
         if not 'amount' in params:
             return status_error('Must have "amount" in params.')
-        amount = dec(params['amount'], prec=ROUND_CRYPTO)
-        if amount < MIN_SIZE:
+        amount = to_units(params['amount'])
+        if amount < MIN_SIZE_UNITS:
             return status_error(
                 'Amount must be greater than or equal to %s' % (MIN_SIZE)
             )
-        if amount > self.wallets[user]['crypto']:
-            return status_error('Not enough crypto to sell. %s > %s' % (amount,self.wallets[user]['crypto']))
+        if amount > MAX_ORDER_VALUE:
+            return status_error('Amount is too large.')
+        if amount > self.wallets[user].crypto:
+            return status_error('Not enough crypto to sell. %s > %s' % (
+                from_units(amount), from_units(self.wallets[user].crypto)))
 
         if len(self.orders['buy']) < 1:
             return status_error('No available buy orders to match.')
-
-        self.wallets[user]['crypto'] = dec(self.wallets[user]['crypto'] - amount, prec=ROUND_CRYPTO)
-        order = {
-            'timestamp':time.time(),
-            'id':user_token(),
-            'price':self.market_price, # Target price, not gauranteed
-            'amount':amount,
-            'side':'sell_market',
-            'status':'open', # : open, filled
-            'filled_size':dec('0.00'),
-            'user':user,
-        }
-        self.market_orders['sell'].append(order)
+        client_oid = params.get('client_oid')
+        error = self._check_client_oid(user, client_oid)
+        if error:
+            return error
+
+        self.wallets[user].crypto -= amount
+        # price is the target price, not gauranteed
+        order = Order(time.time(), new_id(), 'sell_market',
+            self.market_price, user, amount=amount, client_oid=client_oid)
+        self.market_orders['sell'][order.id] = order
+        self._index_order(order)
         self._broadcast({'type':'sell_market', 'message':order})
+        self._match_market_sell(order)
+        self._calc_market_price()
         return status_ok('Market sell order placed.', data=order)
 
     def _calc_market_price(self):
+        """Update best bid/ask, spread and market price from the top of the
+        book. This is O(1) and does nothing unless the best bid or best ask
+        changed since the last update.
+        """
+        if self.deferred is not None:
+            self.deferred.add('price')
+            return
         # TODO: Figure out the best way to calculate market price. Right now
         # it is a naive implementation based off of current maker buy/sell
         # lowest/highest average or previous market price if there is not
         # a current buy or sell placed.
-        #'orders':{'buy':[], 'sell':[]}
-        buys = self.orders['buy']
-        sells = self.orders['sell']
-        highest_buy = dec('0.00')
-        lowest_sell = dec('999999999999.99')
-        found_buy = False
-        found_sell = False
-        for b in buys:
-            if b['status'] != 'open':
-                continue
-            found_buy = True
-            if b['price'] > highest_buy:
-                highest_buy = b['price']
-        for s in sells:
-            if s['status'] != 'open':
-                continue
-            found_sell = True
-            if s['price'] < lowest_sell:
-                lowest_sell = s['price']
+        highest_buy = self.orders.best_bid
+        lowest_sell = self.orders.best_ask
+        if highest_buy == self.highest_buy and lowest_sell == self.lowest_sell:
+            return
+        STATE['highest_buy'] = highest_buy
+        STATE['lowest_sell'] = lowest_sell
+        found_buy = highest_buy is not None
+        found_sell = lowest_sell is not None
 
         if found_sell and not found_buy:
-            tmp_price = dec(
-                (self.market_price + lowest_sell) / dec('2.0'),
-                prec=ROUND_USD
-            )
+            tmp_price = div_round(self.market_price + lowest_sell, 2)
         elif not found_sell and found_buy:
-            tmp_price = dec(
-                (self.market_price + highest_buy) / dec('2.0'),
-                prec=ROUND_USD
-            )
+            tmp_price = div_round(self.market_price + highest_buy, 2)
         elif not found_sell and not found_buy:
             tmp_price = self.market_price
         else:
-            tmp_price = dec(
-            (highest_buy + lowest_sell) / dec('2.0'),
-            prec=ROUND_USD
-        )
+            tmp_price = div_round(highest_buy + lowest_sell, 2)
+        changed = tmp_price != self.market_price
+        if changed:
+            STATE['version'] += 1
         self.market_price = tmp_price
         self.price_history.append(tmp_price)
+        if changed:
+            self._broadcast({'type':'price', 'message':from_cents(tmp_price)})
         # Do some averaging to avoid large jumps per tick
         #price_mean = dec(mean(self.price_history), prec=ROUND_USD)
         #self.market_price = dec(mean([price_mean, tmp_price]), prec=ROUND_USD)
         if found_sell and found_buy:
-            self.spread = dec(lowest_sell - highest_buy, prec=ROUND_USD)
+            self.spread = lowest_sell - highest_buy
         else:
-            self.spread = dec(abs(self.price_history[-2] - self.price_history[-1]), prec=ROUND_USD)
-            if self.spread < 0.01:
-                self.spread = dec('0.01')
-        print('MARKET_PRICE:', self.market_price, 'SPREAD:', self.spread)
+            self.spread = abs(self.price_history[-2] - self.price_history[-1])
+            if self.spread < 1:
+                self.spread = 1
+        print('MARKET_PRICE:', from_cents(self.market_price),
+            'SPREAD:', from_cents(self.spread))
 
     def _match_market_buys(self):
+        if self.deferred is not None:
+            self.deferred.add('buys')
+            return
         buys = filter(
-            lambda x: x['status'] == 'open', self.market_orders['buy']
+            lambda x: x.status == 'open', self.market_orders['buy'].values()
         )
-        for buy in buys:
-            closest = None
-            closest_diff = None
-            sells = filter(lambda x: x['status'] == 'open', self.orders['sell'])
-            target_price = buy['price']
-            for sell in sells:
-                if not closest:
-                    closest = sell
-                    closest_diff = abs(target_price - sell['price'])
-                else:
-                    cdiff = abs(target_price - sell['price'])
-                    if cdiff < closest_diff:
-                        closest = sell
-                        closest_diff = abs(target_price - sell['price'])
-
+        for buy in list(buys):
             # No sells on the exchange, nothing to do.
-            if not closest:
+            if len(self.orders['sell']) < 1:
                 return
-            sell = closest
-            price = sell['price']
-            seller_usd_used = sell['size'] * sell['price']
-            buyers_wallet = self.wallets[buy['user']]
-            sellers_wallet = self.wallets[sell['user']]
-            buy_id = buy['id']
-            sell_id = sell['id']
-            if buy['amount'] > seller_usd_used:
+            self._match_market_buy(buy)
+
+    def _match_market_buy(self, buy):
+        """Sweep the sell side of the book, starting at the lowest price and
+        FIFO within each level, until the market buy is filled or there are
+        no sells left. Unfilled amount stays open for later matching.
+        """
+        sells = self.orders['sell']
+        while buy.status == 'open' and len(sells) > 0:
+            sell = next(iter(sells.level(sells.best).values()))
+            price = sell.price
+            seller_usd_used = notional(price, sell.size)
+            buyers_wallet = self.wallets[buy.user]
+            sellers_wallet = self.wallets[sell.user]
+            if buy.amount > seller_usd_used:
                 # seller is done
-                sell_size = sell['size']
-                sell['status'] = 'filled'
-                sell['size'] = dec('0.00')
-                sell['filled_size'] = dec(sell_size + sell['filled_size'], prec=ROUND_CRYPTO)
-                sellers_wallet['usd'] = dec(sellers_wallet['usd'] + (sell_size * sell['price']), prec=ROUND_USD)
+                sell_size = sell.size
+                sell.status = 'filled'
+                self._reduce_order(sell, sell_size)
+                sell.filled_size += sell_size
+                sellers_wallet.usd += seller_usd_used
                 # buyer is partially done
-                buy['filled_size'] = dec(buy['filled_size'] + sell_size, prec=ROUND_CRYPTO)
-                buy['amount'] = dec(buy['amount'] - seller_usd_used, prec=ROUND_USD)
-                buyers_wallet['crypto'] = dec(buyers_wallet['crypto'] + sell_size, prec=ROUND_CRYPTO)
+                buy.filled_size += sell_size
+                buy.amount -= seller_usd_used
+                buyers_wallet.crypto += sell_size
                 # Move to completed and delete from main orders list
-                self.orders_completed.append(dict(sell))
+                self.orders_completed.append(sell)
                 self._delete_order(sell)
                 filled_size = sell_size
 
-            elif buy['amount'] < seller_usd_used:
-                sell_size = sell['size']
-                # find sold size based off of percentage of usd
-                bs_ratio = buy['amount'] / seller_usd_used
-                buy_size = dec(bs_ratio * sell_size, prec=ROUND_CRYPTO)
+            elif buy.amount < seller_usd_used:
+                # find sold size based off of usd left (rounded down so the
+                # seller is always left with a non-zero size)
+                buy_size = buy.amount * CRYPTO_SCALE // price
                 # seller is partial
-                sell['size'] = dec(sell_size - buy_size, prec=ROUND_CRYPTO)
-                sell['filled_size'] = dec(buy_size + sell['filled_size'], prec=ROUND_CRYPTO)
-                sellers_wallet['usd'] = dec(sellers_wallet['usd'] + (buy_size * sell['price']), prec=ROUND_USD)
+                self._reduce_order(sell, buy_size)
+                sell.filled_size += buy_size
+                sellers_wallet.usd += buy.amount
                 # buyer is done
-                buy['status'] = 'filled'
-                buy['filled_size'] = dec(buy['filled_size'] + buy_size, prec=ROUND_CRYPTO)
-                buy['amount'] = dec('0.00')
-                buyers_wallet['crypto'] = dec(buyers_wallet['crypto'] + buy_size, prec=ROUND_CRYPTO)
+                buy.status = 'filled'
+                buy.filled_size += buy_size
+                buy.amount = 0
+                buyers_wallet.crypto += buy_size
                 # Move to completed and delete from main orders list
-                self.orders_completed.append(dict(buy))
+                self.orders_completed.append(buy)
                 self._delete_market_order(buy)
                 filled_size = buy_size
 
             else: # equal usd value on both sides, both completed
-                sell['status'] = 'filled'
-                sell_size = sell['size']
+                sell.status = 'filled'
+                sell_size = sell.size
                 # seller is done
-                sell['size'] = dec('0.00')
-                sell['filled_size'] = dec(sell_size + sell['filled_size'], prec=ROUND_CRYPTO)
-                sellers_wallet['usd'] = dec(sellers_wallet['usd'] + (sell_size * sell['price']), prec=ROUND_USD)
+                self._reduce_order(sell, sell_size)
+                sell.filled_size += sell_size
+                sellers_wallet.usd += seller_usd_used
                 # buyer is done
-                buy['status'] = 'filled'
-                buy['filled_size'] = dec(buy['filled_size'] + sell_size, prec=ROUND_CRYPTO)
-                buy['amount'] = dec('0.00')
-                buyers_wallet['crypto'] = dec(buyers_wallet['crypto'] + sell_size, prec=ROUND_CRYPTO)
+                buy.status = 'filled'
+                buy.filled_size += sell_size
+                buy.amount = 0
+                buyers_wallet.crypto += sell_size
                 # Move to completed and delete from main orders list
-                self.orders_completed.append(dict(sell))
-                self.orders_completed.append(dict(buy))
+                self.orders_completed.append(sell)
+                self.orders_completed.append(buy)
                 self._delete_order(sell)
                 self._delete_market_order(buy)
                 filled_size = sell_size
 
-            self.user_fills[sell['user']].append({
-                'fill_id':user_token(),
-                'filled_size':filled_size,
-                'price':price,
-                'buy_id':buy_id,
-                'sell_id':sell_id,
-            })
-            self.user_fills[buy['user']].append({
-                'fill_id':user_token(),
-                'filled_size':filled_size,
-                'price':price,
-                'buy_id':buy_id,
-                'sell_id':sell_id,
-            })
-            self._broadcast({'type':'match', 'message':{
-                'size':filled_size,
-                'price':price,
-                'buy_id':buy_id,
-                'sell_id':sell_id,
-            }})
+            self._record_fill(buy, sell, filled_size, price)
 
     def _match_market_sells(self):
+        if self.deferred is not None:
+            self.deferred.add('sells')
+            return
         sells = filter(
-            lambda x: x['status'] == 'open', self.market_orders['sell']
+            lambda x: x.status == 'open', self.market_orders['sell'].values()
         )
-        for sell in sells:
-            closest = None
-            closest_diff = None
-            buys = filter(lambda x: x['status'] == 'open', self.orders['buy'])
-            target_price = sell['price']
-            for buy in buys:
-                if not closest:
-                    closest = buy
-                    closest_diff = abs(target_price - buy['price'])
-                else:
-                    cdiff = abs(target_price - buy['price'])
-                    if cdiff < closest_diff:
-                        closest = buy
-                        closest_diff = abs(target_price - buy['price'])
-
-            # No sells on the exchange, nothing to do.
-            if not closest:
+        for sell in list(sells):
+            # No buys on the exchange, nothing to do.
+            if len(self.orders['buy']) < 1:
                 return
-            buy = closest
-            price = buy['price']
-            buyers_wallet = self.wallets[buy['user']]
-            sellers_wallet = self.wallets[sell['user']]
-            buy_id = buy['id']
-            sell_id = sell['id']
-            sell_size = sell['amount']
-            buy_size = buy['size']
-            if buy['size'] > sell['amount']:
+            self._match_market_sell(sell)
+
+    def _match_market_sell(self, sell):
+        """Sweep the buy side of the book, starting at the highest price and
+        FIFO within each level, until the market sell is filled or there are
+        no buys left. Unfilled amount stays open for later matching.
+        """
+        buys = self.orders['buy']
+        while sell.status == 'open' and len(buys) > 0:
+            buy = next(iter(buys.level(buys.best).values()))
+            price = buy.price
+            buyers_wallet = self.wallets[buy.user]
+            sellers_wallet = self.wallets[sell.user]
+            sell_size = sell.amount
+            buy_size = buy.size
+            if buy_size > sell_size:
                 # seller is done
-                sell['status'] = 'filled'
-                sell['amount'] = dec('0.00')
-                sell['filled_size'] = dec(sell['filled_size'] + sell_size, prec=ROUND_CRYPTO)
-                sellers_wallet['usd'] = dec(sellers_wallet['usd'] + (sell_size * buy['price']), prec=ROUND_USD)
+                sell.status = 'filled'
+                sell.amount = 0
+                sell.filled_size += sell_size
+                sellers_wallet.usd += notional(price, sell_size)
                 # buyer is partial
-                buy['filled_size'] = dec(buy['filled_size'] + sell_size, prec=ROUND_CRYPTO)
-                buy['size'] = dec(buy['size'] - sell_size, prec=ROUND_CRYPTO)
-                buyers_wallet['crypto'] = dec(buyers_wallet['crypto'] + sell_size, prec=ROUND_CRYPTO)
+                buy.filled_size += sell_size
+                self._reduce_order(buy, sell_size)
+                buyers_wallet.crypto += sell_size
                 # Move to completed and delete from main orders list
-                self.orders_completed.append(dict(sell))
+                self.orders_completed.append(sell)
                 self._delete_market_order(sell)
                 filled_size = sell_size
 
-            elif buy['size'] < sell['amount']:
+            elif buy_size < sell_size:
                 # seller is partial
-                sell['filled_size'] = dec(sell['filled_size'] + buy_size, prec=ROUND_CRYPTO)
-                sell['amount'] = dec(sell['amount'] - buy['size'], prec=ROUND_CRYPTO)
-                sellers_wallet['usd'] = dec(sellers_wallet['usd'] + (buy['size'] * buy['price']), prec=ROUND_USD)
+                sell.filled_size += buy_size
+                sell.amount -= buy_size
+                sellers_wallet.usd += notional(price, buy_size)
                 # buyer is done
-                buy['status'] = 'filled'
-                buy['size'] = dec('0.00')
-                buy['filled_size'] = dec(buy['filled_size'] + buy_size, prec=ROUND_CRYPTO)
-                buyers_wallet['crypto'] = dec(buyers_wallet['crypto'] + buy_size, prec=ROUND_CRYPTO)
+                buy.status = 'filled'
+                self._reduce_order(buy, buy_size)
+                buy.filled_size += buy_size
+                buyers_wallet.crypto += buy_size
                 # Move to completed and delete from main orders list
-                self.orders_completed.append(dict(buy))
+                self.orders_completed.append(buy)
                 self._delete_order(buy)
                 filled_size = buy_size
 
             else: # equal usd value on both sides, both completed
                 # seller is done
-                sell['status'] = 'filled'
-                sell['amount'] = dec('0.00')
-                sell['filled_size'] = dec(sell['filled_size'] + sell_size, prec=ROUND_CRYPTO)
-                sellers_wallet['usd'] = dec(sellers_wallet['usd'] + (sell_size * buy['price']), prec=ROUND_USD)
+                sell.status = 'filled'
+                sell.amount = 0
+                sell.filled_size += sell_size
+                sellers_wallet.usd += notional(price, sell_size)
                 # buyer is done
-                buy['status'] = 'filled'
-                buy['size'] = dec('0.00')
-                buy['filled_size'] = dec(buy['filled_size'] + buy_size, prec=ROUND_CRYPTO)
-                buyers_wallet['crypto'] = dec(buyers_wallet['crypto'] + buy_size, prec=ROUND_CRYPTO)
+                buy.status = 'filled'
+                self._reduce_order(buy, buy_size)
+                buy.filled_size += buy_size
+                buyers_wallet.crypto += buy_size
                 # Move to completed and delete from main orders list
-                self.orders_completed.append(dict(sell))
-                self.orders_completed.append(dict(buy))
+                self.orders_completed.append(sell)
+                self.orders_completed.append(buy)
                 self._delete_market_order(sell)
                 self._delete_order(buy)
                 filled_size = sell_size
 
-            self.user_fills[sell['user']].append({
-                'fill_id':user_token(),
-                'filled_size':filled_size,
-                'price':price,
-                'buy_id':buy_id,
-                'sell_id':sell_id,
-            })
-            self.user_fills[buy['user']].append({
-                'fill_id':user_token(),
-                'filled_size':filled_size,
-                'price':price,
-                'buy_id':buy_id,
-                'sell_id':sell_id,
-            })
-            self._broadcast({'type':'match', 'message':{
-                'size':filled_size,
-                'price':price,
-                'buy_id':buy_id,
-                'sell_id':sell_id,
-            }})
-
+            self._record_fill(buy, sell, filled_size, price)
 
     def _fulfill_maker_order_match(self, buy, sell):
         """Matches maker orders"""
@@ -601,101 +968,95 @@ class CxExchange:
         # 5. update status (even though it's removed)
         # 6. add to completed and remove orders
         # 7. broadcast match
-        buy_size = buy['size']
-        sell_size = sell['size']
-        buy_id = buy['id']
-        sell_id = sell['id']
-        buyers_wallet = self.wallets[buy['user']]
-        sellers_wallet = self.wallets[sell['user']]
-        price = sell['price']
+        buy_size = buy.size
+        sell_size = sell.size
+        buyers_wallet = self.wallets[buy.user]
+        sellers_wallet = self.wallets[sell.user]
+        price = sell.price
 
         if buy_size > sell_size:
             # seller changes
-            sell['status'] = 'filled'
-            sell['size'] = dec('0.00')
-            sell['filled_size'] = dec(sell['filled_size'] + sell_size, prec=ROUND_CRYPTO)
-            sellers_wallet['usd'] = dec(sellers_wallet['usd'] + (sell_size * price), prec=ROUND_USD)
+            sell.status = 'filled'
+            self._reduce_order(sell, sell_size)
+            sell.filled_size += sell_size
+            sellers_wallet.usd += notional(price, sell_size)
             # buyer changes
-            buy['size'] = dec(buy_size - sell_size, prec=ROUND_CRYPTO)
-            buy['filled_size'] = dec(sell_size + buy['filled_size'])
-            buyers_wallet['crypto'] = dec(buyers_wallet['crypto'] + sell_size, prec=ROUND_CRYPTO)
+            self._reduce_order(buy, sell_size)
+            buy.filled_size += sell_size
+            buyers_wallet.crypto += sell_size
             filled_size = sell_size
             # Move to completed and delete from main orders list
-            self.orders_completed.append(dict(sell))
+            self.orders_completed.append(sell)
             self._delete_order(sell)
 
         elif buy_size < sell_size:
             # seller changes
-            sell['size'] = dec(sell_size - buy_size, prec=ROUND_CRYPTO)
-            sell['filled_size'] = dec(buy_size + sell['filled_size'])
-            sellers_wallet['usd'] = dec(sellers_wallet['usd'] + (buy_size * price), prec=ROUND_USD)
+            self._reduce_order(sell, buy_size)
+            sell.filled_size += buy_size
+            sellers_wallet.usd += notional(price, buy_size)
             # buyer changes
-            buy['status'] = 'filled'
-            buy['size'] = dec('0.00')
-            buy['filled_size'] = dec(buy_size + buy['filled_size'], prec=ROUND_CRYPTO)
-            buyers_wallet['crypto'] = dec(buyers_wallet['crypto'] + buy_size, prec=ROUND_CRYPTO)
+            buy.status = 'filled'
+            self._reduce_order(buy, buy_size)
+            buy.filled_size += buy_size
+            buyers_wallet.crypto += buy_size
             filled_size = buy_size
-            self.orders_completed.append(dict(buy))
+            self.orders_completed.append(buy)
             self._delete_order(buy)
 
         else: # equal sizes, both fulfilled
             # seller changes
-            sell['status'] = 'filled'
-            sell['size'] = dec('0.00')
-            sell['filled_size'] = dec(sell['filled_size'] + sell_size, prec=ROUND_CRYPTO)
-            sellers_wallet['usd'] = dec(sellers_wallet['usd'] + (sell_size * price), prec=ROUND_USD)
+            sell.status = 'filled'
+            self._reduce_order(sell, sell_size)
+            sell.filled_size += sell_size
+            sellers_wallet.usd += notional(price, sell_size)
             # buyer changes
-            buy['status'] = 'filled'
-            buy['size'] = dec('0.00')
-            buy['filled_size'] = dec(buy_size + buy['filled_size'], prec=ROUND_CRYPTO)
-            buyers_wallet['crypto'] = dec(buyers_wallet['crypto'] + buy_size, prec=ROUND_CRYPTO)
+            buy.status = 'filled'
+            self._reduce_order(buy, buy_size)
+            buy.filled_size += buy_size
+            buyers_wallet.crypto += buy_size
             filled_size = buy_size # or sell_size
             # Move to completed and delete from main order list
-            self.orders_completed.append(dict(buy))
-            self.orders_completed.append(dict(sell))
+            self.orders_completed.append(buy)
+            self.orders_completed.append(sell)
             self._delete_order(buy)
             self._delete_order(sell)
 
-        self.user_fills[sell['user']].append({
-            'fill_id':user_token(),
-            'filled_size':filled_size,
-            'price':price,
-            'buy_id':buy_id,
-            'sell_id':sell_id,
-        })
-        self.user_fills[buy['user']].append({
-            'fill_id':user_token(),
-            'filled_size':filled_size,
-            'price':price,
-            'buy_id':buy_id,
-            'sell_id':sell_id,
+        self._record_fill(buy, sell, filled_size, price)
+
+    def _record_fill(self, buy, sell, filled_size, price):
+        """Add a fill to both users' fills and broadcast the match"""
+        STATE['version'] += 1
+        self.user_fills[sell.user].append(
+            Fill(new_id(), filled_size, price, buy.id, sell.id)
+        )
+        self.user_fills[buy.user].append(
+            Fill(new_id(), filled_size, price, buy.id, sell.id)
+        )
+        self._broadcast({
+            'type':'match',
+            'message':Match(filled_size, price, buy.id, sell.id)
         })
-        self._broadcast({'type':'match', 'message':{
-            'size':filled_size,
-            'price':price,
-            'buy_id':buy_id,
-            'sell_id':sell_id,
-        }})
 
-    def _match_maker_orders(self):
-        """Try to match buys to sells.
+    def _match_maker_order(self, order):
+        """Match an incoming maker order against resting orders on the other
+        side at the same price.
         NOTE:
             - self-trade protection is in place
             - buy/sell priority is FIFO
         """
-        buys = filter(lambda x: x['status'] == 'open', self.orders['buy'])
-        for buy in buys:
-            sells = filter(
-                lambda x:
-                    x['status'] == 'open' and
-                    buy['user'] != x['user'] and
-                    x['price'] == buy['price'],
-                    #(x['price'] == buy['price'] or x['price'] >= buy['price']),
-                self.orders['sell']
-            )
-            for sell in sells:
-                self._fulfill_maker_order_match(buy, sell)
-        self._calc_market_price()
+        other_side = 'sell' if order.side == 'buy' else 'buy'
+        level = self.orders[other_side].level(order.price)
+        if level is None:
+            return
+        for resting in list(level.values()):
+            if order.status != 'open':
+                break
+            if resting.user == order.user:
+                continue
+            if order.side == 'buy':
+                self._fulfill_maker_order_match(order, resting)
+            else:
+                self._fulfill_maker_order_match(resting, order)
 
     def _completed(self, websocket:WebSocketServerProtocol, params:dict):
         if not self._is_authed(websocket):
@@ -709,7 +1070,7 @@ class CxExchange:
             return status_error('Admin secret required.')
         if self.admin_secret == params['secret']:
             self._broadcast({'type':'shutdown', 'message':'Shutdown command.'})
-            # Force a time limit to trigger on next loop
+            # Force a time limit to trigger on next clock tick
             # This way stats/csv will be dumped
             self.time_limit = 1
             return status_ok('Command accepted. Shutting down.')
@@ -743,18 +1104,19 @@ class CxExchange:
         if not self._is_authed(websocket):
             return status_error('Must be authenticated.')
         data = []
-        for order in self.orders['buy']:
-            if order['status'] != 'open':
-                data.append(('ORDER_STATUS_NOT_OPEN:', order))
-        for order in self.orders['sell']:
-            if order['status'] != 'open':
-                data.append(('ORDER_STATUS_NOT_OPEN:', order))
-        for order in self.market_orders['buy']:
-            if order['status'] != 'open':
-                data.append(('ORDER_STATUS_NOT_OPEN:', order))
-        for order in self.market_orders['sell']:
-            if order['status'] != 'open':
+        for order in self.order_index.values():
+            if order.status != 'open':
                 data.append(('ORDER_STATUS_NOT_OPEN:', order))
+        for side in ('buy', 'sell'):
+            book = self.orders[side]
+            for price, level in book.levels.items():
+                size = sum(order.size for order in level.values())
+                if size != book.sizes[price]:
+                    data.append(('LEVEL_SIZE_MISMATCH:', side, price, size, book.sizes[price]))
+        open_count = (len(self.orders['buy']) + len(self.orders['sell']) +
+            len(self.market_orders['buy']) + len(self.market_orders['sell']))
+        if open_count != len(self.order_index):
+            data.append(('ORDER_INDEX_MISMATCH:', open_count, len(self.order_index)))
         return status_ok('Audit done.', data=data)
 
     def _buy(self, websocket:WebSocketServerProtocol, params:dict):
@@ -763,69 +1125,55 @@ class CxExchange:
         user = self._get_user(websocket)
         if not 'size' in params or not 'price' in params:
             return status_error('Must size "price" and "size" in params.')
-        size = dec(params['size'], prec=ROUND_CRYPTO)
-        price = dec(params['price'], prec=ROUND_USD)
-        usd = dec(size * price, prec=ROUND_USD)
-        if size < MIN_SIZE:
+        size = to_units(params['size'])
+        price = to_cents(params['price'])
+        usd = notional(price, size)
+        if size < MIN_SIZE_UNITS:
             return status_error(
                 'Size must be greater than or equal to %s' % (MIN_SIZE)
             )
-        if price < MIN_PRICE:
+        if price < MIN_PRICE_CENTS:
             return status_error(
                 'Price must be greater than or equal to %s' % (MIN_PRICE)
             )
+        if size > MAX_ORDER_VALUE or price > MAX_ORDER_VALUE:
+            return status_error('Price or size is too large.')
         if price >= self.market_price:
             return status_error(
-                'Price must be < market price (%s).' % (self.market_price)
+                'Price must be < market price (%s).' % (from_cents(self.market_price))
             )
-        if usd > self.wallets[user]['usd']:
+        if usd > self.wallets[user].usd:
             return status_error('Not enough USD.')
+        client_oid = params.get('client_oid')
+        error = self._check_client_oid(user, client_oid)
+        if error:
+            return error
 
         # Subtract cost from user's wallet
-        self.wallets[user]['usd'] = dec(self.wallets[user]['usd'] - usd, prec=ROUND_USD)
-        order = {
-            'timestamp':time.time(),
-            'id':user_token(),
-            'size':size,
-            'usd_used':usd,
-            'price':price,
-            'side':'buy',
-            'status':'open', # : open, filled
-            'filled_size':dec('0.00'),
-            'user':user,
-        }
-        self.orders['buy'].append(order)
-        self._calc_market_price()
+        self.wallets[user].usd -= usd
+        order = Order(time.time(), new_id(), 'buy', price, user,
+            size=size, usd_used=usd, client_oid=client_oid)
+        self._add_order(order)
+        self._index_order(order)
         self._broadcast({'type':'buy', 'message':order})
+        self._match_maker_order(order)
+        self._match_market_sells()
+        self._calc_market_price()
         return status_ok('Buy order placed.', data=order)
 
     def _cancel(self, websocket, params, user=False):
         if not user and not self._is_authed(websocket):
             return status_error('Must be authenticated to cancel orders.')
-        if not 'order_id' in params:
+        if not 'order_id' in params and not 'client_oid' in params:
             return status_error('Missing "order_id" in params.')
         if not user:
             user = self.client_user_map[websocket]
-        found = False
-        for order in self.orders['buy']:
-            if order['status'] != 'open':
-                continue
-            if order['id'] == params['order_id']:
-                found = order
-                break
-        for order in self.orders['sell']:
-            if order['status'] != 'open':
-                continue
-            if order['id'] == params['order_id']:
-                if found:
-                    raise Exception('Duplicate order ID between buy/sell. Wat?')
-                found = order
-                break
-
-        if not found:
-            return status_error('Order not found: %s' % (params['order_id']))
+        found = self._find_order(user, params)
+        if not found or found.status != 'open':
+            return status_error('Order not found: %s' % (
+                params.get('order_id', params.get('client_oid'))))
         else:
-            if user != found['user']:
+            if user != found.user:
                 # Found an order that belongs to a different user. Pretend it
                 # doesn't exist.
                 return status_error('Order not found.')
@@ -833,52 +1181,197 @@ class CxExchange:
         # must return order to wallet and update exchange market_price
         # buy cancel gives back usd
         # sell cancel gives back crypto
-        side = found['side']
-        user = found['user']
+        side = found.side
+        user = found.user
         if side == 'sell':
-            self.wallets[user]['crypto'] = dec(
-                self.wallets[user]['crypto'] + found['size']
-            )
+            self.wallets[user].crypto += found.size
+        elif side == 'sell_market':
+            self.wallets[user].crypto += found.amount
+        elif side == 'buy_market':
+            self.wallets[user].usd += found.amount
         else:
-            usd_calc = found['price'] * found['size']
-            self.wallets[user]['usd'] = dec(
-                self.wallets[user]['usd'] + usd_calc,
-                prec=ROUND_USD
-            )
+            self.wallets[user].usd += notional(found.price, found.size)
 
-        found['status'] = 'cancel'
+        found.status = 'cancel'
         # Move the order to completed list if filled_size > 0, then delete the
         # order in all cases.
-        if found['filled_size'] > 0:
-            self.orders_completed.append(dict(found))
+        if found.filled_size > 0:
+            self.orders_completed.append(found)
 
-        if not self._delete_order(found):
+        if side in ('buy_market', 'sell_market'):
+            deleted = self._delete_market_order(found)
+        else:
+            deleted = self._delete_order(found)
+        if not deleted:
             print('NOTICE: Order was not found while attempting to delete.')
 
         self._calc_market_price()
-        self.queue.put(
-            jencode({'type':'cancel', 'message':params['order_id'],})
-        )
+        event = {'type':'cancel', 'message':found.id}
+        if found.client_oid is not None:
+            event['client_oid'] = found.client_oid
+        self._broadcast(event)
         return status_ok('Order cancelled and removed.')
 
+    def _order(self, websocket, params):
+        """Look up one of the user's orders by order_id (open orders) or
+        client_oid (open or completed orders)
+        """
+        if not self._is_authed(websocket):
+            return status_error('Must be authenticated to get orders.')
+        if not 'order_id' in params and not 'client_oid' in params:
+            return status_error('Missing "order_id" or "client_oid" in params.')
+        user = self._get_user(websocket)
+        found = self._find_order(user, params)
+        if not found or found.user != user:
+            return status_error('Order not found.')
+        return status_ok('Order.', data=found)
+
+    def _find_order(self, user, params):
+        """Order by params['order_id'], else by the user's
+        params['client_oid']. None if there is no such order or the id is
+        not a string (e.g. an unhashable list from a client).
+        """
+        if 'order_id' in params:
+            order_id = params['order_id']
+            if not isinstance(order_id, str):
+                return None
+            return self.order_index.get(order_id)
+        client_oid = params['client_oid']
+        if not isinstance(client_oid, str):
+            return None
+        return self.client_oids.get((user, client_oid))
+
+    def _check_client_oid(self, user, client_oid):
+        """Error response if an order's optional client_oid is invalid or
+        already used by the user, else None
+        """
+        if client_oid is None:
+            return None
+        if (not isinstance(client_oid, str) or not client_oid or
+                len(client_oid) > MAX_CLIENT_OID):
+            return status_error(
+                '"client_oid" must be a string of 1 to %d characters.' % (
+                    MAX_CLIENT_OID)
+            )
+        if (user, client_oid) in self.client_oids:
+            return status_error('Duplicate client_oid: %s' % (client_oid))
+        return None
+
+    def _batch(self, websocket, params):
+        """Apply a list of buy/sell/market/cancel ops in one engine step. Each
+        op is {'cmd':..., 'params':{...}} and is checked against the market
+        price from before the batch. Open market orders are matched against
+        the new book and the market price is recalculated once, at the end.
+        """
+        if not self._is_authed(websocket):
+            return status_error('Must be authenticated.')
+        ops = params.get('ops')
+        if not isinstance(ops, list):
+            return status_error('Missing "ops" list in params.')
+        if len(ops) > self.batch_limit:
+            return status_error('Too many ops, max is %d.' % (self.batch_limit))
+        results = []
+        self.deferred = set()
+        try:
+            for op in ops:
+                cmd_type = op.get('cmd') if isinstance(op, dict) else None
+                if not cmd_type in self.batch_cmds:
+                    results.append(
+                        {'status':False, 'message':'Invalid op.', 'data':None}
+                    )
+                    continue
+                try:
+                    (rc, response, data) = self.cmds[cmd_type](
+                        websocket, op.get('params') or {}
+                    )
+                except Exception as err:
+                    (rc, response, data) = status_error(
+                        'Invalid command: %s. error=%s' % (cmd_type, err)
+                    )
+                results.append({'status':rc, 'message':response, 'data':data})
+        finally:
+            deferred = self.deferred
+            self.deferred = None
+            if 'sells' in deferred:
+                self._match_market_sells()
+            if 'buys' in deferred:
+                self._match_market_buys()
+            self._calc_market_price()
+        return status_ok('Batch done.', data=results)
+
+    def _cancel_all(self, websocket, params):
+        """Cancel all of the user's open maker and market orders"""
+        if not self._is_authed(websocket):
+            return status_error('Must be authenticated to cancel orders.')
+        user = self._get_user(websocket)
+        order_ids = list(self.user_orders[user])
+        for order_id in order_ids:
+            self._cancel(websocket, {'order_id':order_id}, user=user)
+        return status_ok('Cancelled %d orders.' % (len(order_ids)), data=order_ids)
+
+    def _index_order(self, order):
+        STATE['version'] += 1
+        self.order_index[order.id] = order
+        self.user_orders[order.user][order.id] = order
+        if order.client_oid is not None:
+            self.client_oids[(order.user, order.client_oid)] = order
+
+    def _unindex_order(self, order):
+        STATE['version'] += 1
+        self.order_index.pop(order.id, None)
+        self.user_orders[order.user].pop(order.id, None)
+
     def _delete_market_order(self, order):
         key = 'buy'
-        if 'sell' in order['side']:
+        if 'sell' in order.side:
             key = 'sell'
-
-        for i,o in enumerate(self.market_orders[key]):
-            if o['id'] == order['id']:
-                del(self.market_orders[key][i])
-                return True
-        return False
-
+        self._unindex_order(order)
+        return self.market_orders[key].pop(order.id, None) is not None
 
     def _delete_order(self, order):
-        for i,o in enumerate(self.orders[order['side']]):
-            if o['id'] == order['id']:
-                del(self.orders[order['side']][i])
-                return True
-        return False
+        self._unindex_order(order)
+        level_size = self.orders.remove(order)
+        if level_size is None:
+            return False
+        # Fully filled orders were already reduced to 0 (no level change)
+        if order.size:
+            self._l2_update(order, level_size)
+        return True
+
+    def _add_order(self, order):
+        self._l2_update(order, self.orders.add(order))
+
+    def _reduce_order(self, order, size):
+        """Fill size off a resting maker order"""
+        self._l2_update(order, self.orders.reduce(order, size))
+
+    def _l2_update(self, order, level_size):
+        """Broadcast the new total size of the order's price level"""
+        STATE['l2_seq'] += 1
+        if not self.queue.wants('l2'):
+            return
+        self._broadcast({
+            'type':'l2',
+            'message':Level(STATE['l2_seq'], order.side, order.price, level_size)
+        })
+
+    def _l2_snapshot(self):
+        """Broadcast the full aggregated book. Deltas with a seq greater than
+        the snapshot's seq apply on top of it.
+        """
+        if not self.queue.wants('l2_snapshot'):
+            return
+        self._broadcast({'type':'l2_snapshot', 'message':{
+            'seq':STATE['l2_seq'],
+            'bids':[
+                (from_cents(price), from_units(size))
+                    for price, size in self.orders['buy'].depth()
+            ],
+            'asks':[
+                (from_cents(price), from_units(size))
+                    for price, size in self.orders['sell'].depth()
+            ],
+        }})
 
     def _bcast(self, websocket, params):
         if not self._is_authed(websocket):
@@ -886,44 +1379,23 @@ class CxExchange:
         if not 'message' in params:
             return status_error('Missing "message" in params.')
         user = self.client_user_map[websocket]
-        self.queue.put(
-            jencode({'type':'bcast', 'message':params['message'], 'user':user})
-        )
+        self._broadcast({'type':'bcast', 'message':params['message'], 'user':user})
         return status_ok('Message broadcasted.')
 
     def _price(self, websocket, params):
         if not self._is_authed(websocket):
             return status_error('Must be authenticated to get market price.')
-        return status_ok('Market price.', data=self.market_price)
-
-    def _get_open_orders(self, websocket):
-        orders = []
-        u = self.client_user_map[websocket]
-        for order in self.orders['buy']:
-            if order['user'] == u:
-                orders.append(order)
-        for order in self.orders['sell']:
-            if order['user'] == u:
-                orders.append(order)
-        return orders
+        return status_ok('Market price.', data=from_cents(self.market_price))
 
     def _all_orders(self, websocket, params):
         if not self._is_authed(websocket):
             return status_error('Must be authenticated to get open orders.')
         try:
             data = {'maker':[], 'market':[]}
-            for order in self.orders['buy']:
-                if order['status'] == 'open':
-                    data['maker'].append(order)
-            for order in self.orders['sell']:
-                if order['status'] == 'open':
-                    data['maker'].append(order)
-            for order in self.market_orders['buy']:
-                if order['status'] == 'open':
-                    data['market'].append(order)
-            for order in self.market_orders['sell']:
-                if order['status'] == 'open':
-                    data['market'].append(order)
+            data['maker'].extend(self.orders['buy'])
+            data['maker'].extend(self.orders['sell'])
+            data['market'].extend(self.market_orders['buy'].values())
+            data['market'].extend(self.market_orders['sell'].values())
             return status_ok('All orders list.', data=data)
         except Exception as err:
             data = err
@@ -935,13 +1407,10 @@ class CxExchange:
         try:
             user = self.client_user_map[websocket]
             data = {'maker':[], 'market':[]}
-            maker = self._get_open_orders(websocket)
-            data['maker'] = maker
-            for order in self.market_orders['buy']:
-                if order['status'] == 'open' and order['user'] == user:
-                    data['market'].append(order)
-            for order in self.market_orders['sell']:
-                if order['status'] == 'open' and order['user'] == user:
+            for order in self.user_orders[user].values():
+                if order.side in ('buy', 'sell'):
+                    data['maker'].append(order)
+                else:
                     data['market'].append(order)
             return status_ok('Open orders list.', data=data)
         except Exception as err:
@@ -968,11 +1437,13 @@ class CxExchange:
         self.users[user] = token
         if not user in self.user_fills:
             self.user_fills[user] = []
-        self.wallets[user] = {'usd':self.usd_start, 'crypto':self.crypto_start}
-        self.client_user_map[websocket] = user
-        self.queue.put(
-            jencode({'type':'info', 'message':'Registered: %s' % (user)})
+        if not user in self.user_orders:
+            self.user_orders[user] = {}
+        self.wallets[user] = Wallet(
+            to_cents(self.usd_start), to_units(self.crypto_start)
         )
+        self.client_user_map[websocket] = user
+        self._broadcast({'type':'info', 'message':'Registered: %s' % (user)})
         return status_ok('Registered', data=token)
 
     def _auth(self, websocket, params):
@@ -987,105 +1458,143 @@ class CxExchange:
         if params['token'] != self.users[user]:
             return status_error('Authentication failed: Invalid token.')
         self.client_user_map[websocket] = user
-        self.queue.put(
-            jencode({'type':'info', 'message':'Authenticated: %s' % (user)})
-        )
+        self._broadcast({'type':'info', 'message':'Authenticated: %s' % (user)})
         return status_ok('Authenticated')
 
+    def _end_game(self):
+        """Stop the exchange and broadcast final holdings as csv"""
+        print('Time limit reached. Shutting down...')
+        self.running = False
+        self._broadcast({
+            'type':'shutdown',
+            'message':'Time limit reached. Shutting down.'
+        })
+        # Calculate final holdings for each user
+        # Cancel all orders to return it to wallets
+        final_price = self.market_price
+        for order in list(self.order_index.values()):
+            self._cancel(None, {'order_id':order.id}, user=order.user)
+        csv = '"user","crypto","usd","holdings"\n'
+        for username in self.users.keys():
+            wallet = self.wallets[username]
+            csv += '"{}","{}","{}","{}"\n'.format(
+                username.replace('"', '-'),
+                from_units(wallet.crypto),
+                from_cents(wallet.usd),
+                from_cents(wallet.usd + notional(final_price, wallet.crypto))
+            )
+
+        self._broadcast({
+            'type':'csv',
+            'message':'Time limit reached. Shutting down.',
+            'data':csv,
+        })
+        print(csv)
+
+    async def _clock(self):
+        """Game clock. A single task per server (not per connection) that
+        watches time_limit, then settles the game and closes connections.
+        """
+        while self.running:
+            await asyncio.sleep(self.clock_interval)
+            now = time.time()
+            if (self.l2_snapshot_interval and
+                    now - self.l2_snapshot_time >= self.l2_snapshot_interval):
+                self.l2_snapshot_time = now
+                self._l2_snapshot()
+            if not self.time_limit:
+                continue
+            if now - self.time_start > self.time_limit:
+                with self.queue.step():
+                    self._end_game()
+                for websocket in list(self.clients):
+                    await websocket.close()
+
+    def _run_cmd(self, websocket, cmd_type: str, params: dict, fmt) -> Any:
+        """Run a command and return the response encoded with fmt. Shared
+        read commands are encoded once per state version.
+        """
+        cached = cmd_type in self.cached_cmds and self._is_authed(websocket)
+        if cached:
+            key = (cmd_type, fmt)
+            hit = self.response_cache.get(key)
+            if hit and hit[0] == STATE['version']:
+                return hit[1]
+        with self.queue.step():
+            (rc, response, data) = self.cmds[cmd_type](websocket, params)
+        encoded = fmt(rc, response, data=data)
+        if cached and rc:
+            self.response_cache[key] = (STATE['version'], encoded)
+        return encoded
+
     async def _handler(self, websocket):
         """Main server loop"""
+        # Connections that negotiated the binary subprotocol use wire frames
+        binary = websocket.subprotocol == wire.SUBPROTOCOL
+        fmt = wire.encode_response if binary else cmd_fmt
+        tag = wire.set_req_id if binary else set_req_id
+        # Requests are answered in order. A client can have many in flight
+        # and match responses by the optional req_id, which is echoed back.
+        # Users can share a connection (see client.CxPool) by sending a
+        # session name with each request. Each (websocket, session) is
+        # authenticated on its own and is the identity the command sees.
+        sessions = set()
         # self.running can be used to gracefully shutdown handlers
-        while self.running:
-            await asyncio.sleep(0.1)
-            if self.time_limit:
-                tdiff = time.time() - self.time_start
-                if tdiff > self.time_limit:
-                    print('Time limit reached. Shutting down...')
-                    self.running = False
-                    self._broadcast({
-                        'type':'shutdown',
-                        'message':'Time limit reached. Shutting down.'
-                    })
-                    # Calculate final holdings for each user
-                    # Cancel all orders to return it to wallets
-                    final_price = self.market_price
-                    csv = '"user","crypto","usd","holdings"\n'
-                    for username in self.users.keys():
-                        for order in self.orders['buy']+self.orders['sell']+self.market_orders['buy']+self.market_orders['sell']:
-                            if order['user'] != username:
-                                continue
-                            self._cancel(None, {'order_id':order['id']}, user=username)
-
-                        wallet = self.wallets[username]
-                        csv += '"{}","{}","{}","{}"\n'.format(
-                            username.replace('"', '-'),
-                            wallet['crypto'],
-                            wallet['usd'],
-                            dec(wallet['usd'] + (wallet['crypto']*final_price), prec=ROUND_USD)
-                        )
-
-                    self._broadcast({
-                        'type':'csv',
-                        'message':'Time limit reached. Shutting down.',
-                        'data':csv,
-                    })
-                    print(csv)
-                    break
-
-            try:
-                message = await websocket.recv()
-                data = jdecode(message)
-                cmd_type = get_cmd_type(data)
-                if not self.is_started and cmd_type and not cmd_type in ('start', 'auth', 'register'):
-                    await websocket.send(
-                        cmd_error('Server is paused. Wait for admin "start" command.')
-                    )
-                    continue
-
-                if not cmd_type:
-                    await websocket.send(cmd_error('Invalid message'))
-                else:
-                    try:
-                        cmd = self.cmds[cmd_type]
-                        (rc, response, data) = cmd(websocket, data['params'])
-                        await websocket.send(
-                            cmd_fmt(rc, response, data=data)
-                        )
-                    except Exception as err:
-                        tb = traceback.format_exc()
-                        print('-'*80, '\n', tb, '\n')
-                        await websocket.send(
-                            cmd_error('Invalid command: %s. error=%s' % (
-                                cmd_type, err))
-                        )
-                    try:
-                        self._match_market_buys()
-                        self._match_market_sells()
-                        self._match_maker_orders()
-                    except Exception as err:
-                        tb = traceback.format_exc()
-                        print('-'*80, '\n', tb, '\n')
-                        await websocket.send(
-                            cmd_error('Command error: %s. error=%s' % (
+        try:
+            while self.running:
+                try:
+                    message = await websocket.recv()
+                    if not self.running:
+                        break
+                    if binary:
+                        try:
+                            data = wire.decode_command(message)
+                        except Exception as err:
+                            print('EDECODE:', err)
+                            data = False
+                    else:
+                        data = jdecode(message)
+                    cmd_type = get_cmd_type(data)
+                    req_id = data.get('req_id') if isinstance(data, dict) else None
+                    session = data.get('session') if cmd_type else None
+                    client = websocket
+                    if session is not None:
+                        client = (websocket, session)
+                    if session is not None and not isinstance(session, (str, int)):
+                        response = fmt(False, 'Invalid session')
+                    elif not self.is_started and cmd_type and not cmd_type in ('start', 'auth', 'register'):
+                        response = fmt(False, 'Server is paused. Wait for admin "start" command.')
+                    elif not cmd_type:
+                        response = fmt(False, 'Invalid message')
+                    else:
+                        # Matching happens inside the commands that change the
+                        # book, against the incoming order only.
+                        if session is not None:
+                            sessions.add(client)
+                        try:
+                            response = self._run_cmd(
+                                client, cmd_type, data['params'], fmt
+                            )
+                        except Exception as err:
+                            tb = traceback.format_exc()
+                            print('-'*80, '\n', tb, '\n')
+                            response = fmt(False, 'Invalid command: %s. error=%s' % (
                                 cmd_type, err))
-                        )
+                    if req_id is not None:
+                        response = tag(response, req_id)
+                    await websocket.send(response)
 
-            except:
-                # NOTE: To debug, print traceback
-                #tb = traceback.format_exc()
-                #print('-'*80, '\n', tb, '\n')
-                self.clients.remove(websocket)
-                try:
-                    del(self.client_user_map[websocket])
                 except:
-                    # TODO:
-                    # Sometimes the client_user_map doesn't contain websocket
-                    # yet? Race condition?
                     # NOTE: To debug, print traceback
                     #tb = traceback.format_exc()
                     #print('-'*80, '\n', tb, '\n')
-                    pass
-                break
+                    break
+        finally:
+            # Every exit (disconnect, error or shutdown) forgets the client
+            self.clients.discard(websocket)
+            for client in sessions:
+                self.client_user_map.pop(client, None)
+            self.client_user_map.pop(websocket, None)
 
     async def handler(self, websocket, path):
         """Event loop handler wrapper"""
@@ -1112,9 +1621,11 @@ class CxExchange:
                 ssl_context.verify_mode = ssl.CERT_NONE
         asyncio.set_event_loop(asyncio.new_event_loop())
         start_server = websockets.serve(
-            self.handler, self.bind, self.port, ssl=ssl_context
+            self.handler, self.bind, self.port, ssl=ssl_context,
+            subprotocols=[wire.SUBPROTOCOL]
         )
         asyncio.get_event_loop().run_until_complete(start_server)
+        asyncio.get_event_loop().create_task(self._clock())
         asyncio.get_event_loop().run_forever()
 
 class CxServer:
@@ -1130,7 +1641,12 @@ class CxServer:
             pem_file: str = None,
             ssl_verify: bool = True,
             admin_secret: str = 'admin',
-            is_started: bool = True):
+            is_started: bool = True,
+            feed_queue_size: int = 1000,
+            feed_slow_policy: str = 'drop_oldest',
+            feed_replay_size: int = 10000,
+            feed_coalesce_ms: float = None,
+            l2_snapshot_interval: float = 5.0):
         self.exchange_port = exchange_port
         self.feed_port = feed_port
         self.bind = bind
@@ -1143,6 +1659,11 @@ class CxServer:
         self.ssl_verify = ssl_verify
         self.admin_secret = admin_secret
         self.is_started = is_started
+        self.feed_queue_size = feed_queue_size
+        self.feed_slow_policy = feed_slow_policy
+        self.feed_replay_size = feed_replay_size
+        self.feed_coalesce_ms = feed_coalesce_ms
+        self.l2_snapshot_interval = l2_snapshot_interval
 
     def start(self):
         feed = CxFeed(
@@ -1150,6 +1671,10 @@ class CxServer:
             bind=self.bind,
             pem_file=self.pem_file,
             ssl_verify=self.ssl_verify,
+            send_queue_size=self.feed_queue_size,
+            slow_policy=self.feed_slow_policy,
+            replay_size=self.feed_replay_size,
+            coalesce_ms=self.feed_coalesce_ms,
         )
         exchange = CxExchange(
             port=self.exchange_port,
@@ -1163,6 +1688,7 @@ class CxServer:
             pem_file=self.pem_file,
             ssl_verify=self.ssl_verify,
             is_started=self.is_started,
+            l2_snapshot_interval=self.l2_snapshot_interval,
         )
         t1 = threading.Thread(target=feed.start)
         t2 = threading.Thread(target=exchange.start)
@@ -1271,6 +1797,46 @@ def main():
         type=str,
         help='Tells the server to accept commands or not (yes|no). If False, server is still able to register users. Useful for waiting for all users to connect before game starts.'
     )
+    parser.add_argument(
+        '-q',
+        '--feedqueuesize',
+        dest='feedqueuesize',
+        default=1000,
+        type=int,
+        help='Max messages queued per feed client before the slow client policy applies.'
+    )
+    parser.add_argument(
+        '-o',
+        '--feedslowpolicy',
+        dest='feedslowpolicy',
+        default='drop_oldest',
+        choices=SLOW_POLICIES,
+        help='What to do with slow feed clients (drop_oldest|conflate|disconnect).'
+    )
+    parser.add_argument(
+        '-r',
+        '--feedreplaysize',
+        dest='feedreplaysize',
+        default=10000,
+        type=int,
+        help='Recent feed events kept for clients resuming after a reconnect (0 disables).'
+    )
+    parser.add_argument(
+        '-k',
+        '--feedcoalescems',
+        dest='feedcoalescems',
+        default=None,
+        type=float,
+        help='Batch feed events into JSON array frames: 0 per engine step, > 0 also wait this many ms (default: a frame per event).'
+    )
+    parser.add_argument(
+        '-l',
+        '--l2snapshotinterval',
+        dest='l2snapshotinterval',
+        default=5.0,
+        type=float,
+        help='Seconds between level 2 book snapshots on the feed (0 disables).'
+    )
     args = parser.parse_args()
     if args.whitelist_path:
         try:
@@ -1307,5 +1873,10 @@ def main():
         pem_file=args.pemfile,
         ssl_verify=args.sslverify,
         is_started=args.started,
+        feed_queue_size=args.feedqueuesize,
+        feed_slow_policy=args.feedslowpolicy,
+        feed_replay_size=args.feedreplaysize,
+        feed_coalesce_ms=args.feedcoalescems,
+        l2_snapshot_interval=args.l2snapshotinterval,
     )
     cxs.start()
@@ -1,5 +1,6 @@
 import time
 import random
+import itertools
 import hashlib
 import json
 from typing import Tuple, Union, Any, Dict, Optional
@@ -16,6 +17,14 @@ ROUND_USD = Decimal('0.00')
 MIN_SIZE = Decimal('0.00000001')
 MIN_PRICE = Decimal('0.1')
 MIN_AMOUNT = Decimal('10.00')
+# Longest client order id (client_oid) accepted
+MAX_CLIENT_OID = 64
+
+# The exchange engine stores USD (prices, amounts, wallets) as integer cents
+# and crypto sizes as integer units of 1e-10. Decimal is only used when
+# reading client params and when encoding responses/broadcasts.
+USD_SCALE = 100
+CRYPTO_SCALE = 10000000000
 
 def mean(l):
     if not l or len(l) < 2:
@@ -29,10 +38,13 @@ def shuffle2(l:list) -> list:
     return x
 
 class DecimalEncoder(json.JSONEncoder):
-    """Makes it so json.dumps(x, cls=DecimalEncoder) can handle Decimal"""
+    """Makes it so json.dumps(x, cls=DecimalEncoder) can handle Decimal and
+    engine records (anything with an as_dict() method, see records.py)"""
     def default(self, o):
         if isinstance(o, Decimal):
             return str(o)
+        if hasattr(o, 'as_dict'):
+            return o.as_dict()
         return super(DecimalEncoder, self).default(o)
 
 def dec_rnd(
@@ -46,6 +58,57 @@ def dec(s, prec: Decimal=None, rounding=ROUND_HALF_EVEN) -> Decimal:
         return dec_rnd(str(s), prec=prec, rounding=rounding)
     return Decimal(str(s))
 
+class Cents(int):
+    """A USD value that is already integer cents (e.g. from the binary wire
+    format). to_cents() passes it through instead of treating it as dollars.
+    """
+
+class Units(int):
+    """A crypto value that is already integer 1e-10 units, see Cents"""
+
+def to_cents(s: Union[int, str, float, Decimal]) -> int:
+    """Decimal/str/float USD value to integer cents (rounded half even)"""
+    if isinstance(s, Cents):
+        return int(s)
+    return int(dec(s, prec=ROUND_USD).scaleb(2))
+
+def to_units(s: Union[int, str, float, Decimal]) -> int:
+    """Decimal/str/float crypto value to integer 1e-10 units"""
+    if isinstance(s, Units):
+        return int(s)
+    return int(dec(s, prec=ROUND_CRYPTO).scaleb(10))
+
+def from_cents(i: int) -> Decimal:
+    return Decimal(i).scaleb(-2)
+
+# Zero crypto goes out as "0.00" like the pre-integer engine did, not "0E-10"
+ZERO_UNITS = Decimal('0.00')
+
+def from_units(i: int) -> Decimal:
+    if not i:
+        return ZERO_UNITS
+    return Decimal(i).scaleb(-10)
+
+def div_round(n: int, d: int) -> int:
+    """Integer n / d rounded half even (same rounding as dec())"""
+    q, r = divmod(n, d)
+    r2 = r * 2
+    if r2 > d or (r2 == d and q & 1):
+        q += 1
+    return q
+
+def notional(price: int, size: int) -> int:
+    """USD cents for size units at price cents"""
+    return div_round(price * size, CRYPTO_SCALE)
+
+# Minimums in engine units
+MIN_SIZE_UNITS = to_units(MIN_SIZE)
+MIN_PRICE_CENTS = to_cents(MIN_PRICE)
+MIN_AMOUNT_CENTS = to_cents(MIN_AMOUNT)
+# Maximum for order prices, sizes and amounts in engine units: the range of
+# the binary wire format's signed 64 bit fields
+MAX_ORDER_VALUE = 2**63 - 1
+
 def dec_str(s: Union[int, float, str]) -> str:
     """Convert a string, int, or float to string, then to decimal, then back to
     a string. This avoids floating point innacuracies when passing in floats
@@ -67,6 +130,12 @@ def cmd_fmt(status: bool, msg: str, data: Any=None) -> str:
     }
     return json.dumps(response, cls=DecimalEncoder)
 
+def set_req_id(response: str, req_id: Any) -> str:
+    """Add 'req_id' to an encoded cmd_fmt() response. Same result as
+    encoding the response with the key, but works on cached responses.
+    """
+    return '%s, "req_id": %s}' % (response[:-1], jencode(req_id))
+
 def cmd_error(msg, data=None):
     return cmd_fmt(False, msg, data=data)
 
@@ -82,6 +151,7 @@ CMDS = (
     'sell',
     'sell_market',
     'cancel',
+    'cancel_all',
     'price',
     'orders',
     'all_orders',
@@ -92,8 +162,32 @@ CMDS = (
     'shutdown',
     'start',
     'pause',
+    'batch',
+    'order',
 )
 
+# Feed topics and the event types each one carries. Feed clients subscribe
+# to topics with: {'cmd':'subscribe', 'params':{'topics':['trades', ...]}}
+FEED_TOPICS = {
+    'trades':('match',),
+    'book':('l2', 'l2_snapshot', 'price'),
+    'orders':('buy', 'sell', 'buy_market', 'sell_market', 'cancel'),
+    'chat':('bcast',),
+    'info':('info',),
+    'admin':('shutdown', 'start', 'pause', 'csv'),
+}
+
+# Event type -> topic
+EVENT_TOPICS = {
+    event_type:topic
+        for topic, event_types in FEED_TOPICS.items()
+            for event_type in event_types
+}
+
+def event_topic(event_type: str) -> str:
+    """Topic an event type is published on. Unknown types go to info."""
+    return EVENT_TOPICS.get(event_type, 'info')
+
 def get_cmd_type(data):
     if not 'cmd' in data:
         return False
@@ -116,7 +210,27 @@ def jencode(msg):
     return json.dumps(msg, cls=DecimalEncoder)
 
 def user_token():
+    """Random auth token. Too slow for order/fill ids, use new_id() there."""
     r1 = str(random.getrandbits(256))
     r2 = str(time.time())
     r = (r1+r2).encode('utf-8')
     return hashlib.sha256(r).hexdigest()
+
+class IdGen:
+    """Cheap, unique, sortable ids.
+
+    An id is a fixed width hex string: server start time (8), random node
+    id (4), then a sequence number (12). Ids from one generator sort in the
+    order they were created, and a restarted server sorts after the last run.
+    """
+    def __init__(self, node: int = None):
+        if node is None:
+            node = random.getrandbits(16)
+        self.prefix = '%08x%04x' % (int(time.time()), node & 0xffff)
+        self._seq = itertools.count(1)
+
+    def __call__(self) -> str:
+        return '%s%012x' % (self.prefix, next(self._seq))
+
+# Order and fill ids
+new_id = IdGen()
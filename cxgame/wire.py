@@ -0,0 +1,473 @@
+"""Compact binary wire format, an opt-in alternative to JSON.
+
+A connection that negotiates the SUBPROTOCOL websocket subprotocol sends and
+receives binary frames instead of JSON text, on both the exchange and the
+feed. Prices and USD are integer cents and crypto is integer 1e-10 units (the
+engine's own units, see util.to_cents/to_units), so neither end parses or
+formats decimals on the hot path. Anything without a fixed layout below is
+carried as a JSON frame, so every command, response and event works in both
+formats.
+
+Every frame starts with a kind byte:
+
+    KIND_JSON -- the rest of the frame is a UTF-8 JSON message
+    KIND_CMD -- a command: cmd code (index in util.CMDS), req_id, then fixed
+        params. Order commands can end with a client_oid.
+    KIND_RESPONSE -- a response: status, data type, req_id, message, then data
+    KIND_EVENT -- a feed event: event code, feed seq, then the message
+    KIND_BATCH -- coalesced feed frames, each prefixed with its length
+    KIND_SESSION -- a command for one session of a shared connection (see
+        client.CxPool): the session name, then a KIND_CMD or KIND_JSON frame
+
+Decoded orders are dicts with every order key (not only the keys of the
+order's side like the JSON format), fills and events are dicts shaped like
+their JSON counterparts. All values are integers instead of decimal strings.
+
+Request ids (req_id) are unsigned 32 bit ints here, 0 meaning none.
+"""
+import json
+import struct
+from decimal import Decimal
+from typing import Any, List, Optional, Tuple
+from .util import (CMDS, Cents, Units, to_cents, to_units, from_cents,
+    from_units, jencode)
+from .records import Order, Fill, Wallet
+
+SUBPROTOCOL = 'cxgame.bin'
+
+KIND_JSON = 0
+KIND_CMD = 1
+KIND_RESPONSE = 2
+KIND_EVENT = 3
+KIND_BATCH = 4
+KIND_SESSION = 5
+
+SIDES = ('buy', 'sell', 'buy_market', 'sell_market')
+STATUSES = ('open', 'filled', 'cancel')
+# Feed events with a fixed layout, the rest are sent as JSON frames
+EVENTS = (
+    'buy', 'sell', 'buy_market', 'sell_market', 'cancel', 'match', 'l2', 'price'
+)
+
+SIDE_CODES = {side:i for i, side in enumerate(SIDES)}
+STATUS_CODES = {status:i for i, status in enumerate(STATUSES)}
+EVENT_CODES = {event_type:i for i, event_type in enumerate(EVENTS)}
+CMD_CODES = {cmd:i for i, cmd in enumerate(CMDS)}
+
+# Commands without params
+BARE_CMDS = (
+    'cancel_all', 'price', 'orders', 'all_orders', 'wallets', 'fills',
+    'completed', 'audit',
+)
+
+# Response data types
+DATA_NONE = 0
+DATA_JSON = 1
+DATA_PRICE = 2
+DATA_ORDER = 3
+DATA_ORDERS = 4
+DATA_ORDER_SETS = 5
+DATA_FILLS = 6
+DATA_WALLET = 7
+DATA_RESULTS = 8
+
+_STR = struct.Struct('<H')
+_LEN = struct.Struct('<I')
+_CMD = struct.Struct('<BBI')
+_CMD_PRICE_SIZE = struct.Struct('<BBIqq')
+_CMD_AMOUNT = struct.Struct('<BBIq')
+_RESPONSE = struct.Struct('<BBBI')
+_REQ_ID = struct.Struct('<I')
+MAX_REQ_ID = 0xffffffff
+_EVENT = struct.Struct('<BBQ')
+_ORDER = struct.Struct('<dBBqqqqq')
+_FILL = struct.Struct('<qq')
+_MATCH = struct.Struct('<qq')
+_LEVEL = struct.Struct('<QBqq')
+_INT = struct.Struct('<q')
+_WALLET = struct.Struct('<qq')
+
+def json_frame(message: str) -> bytes:
+    """Wrap an encoded JSON message in a binary frame"""
+    return bytes((KIND_JSON,)) + message.encode('utf-8')
+
+def batch_frame(frames: List[bytes]) -> bytes:
+    return bytes((KIND_BATCH,)) + b''.join(
+        _LEN.pack(len(frame)) + frame for frame in frames
+    )
+
+def _pack_str(s: str) -> bytes:
+    b = s.encode('utf-8')
+    return _STR.pack(len(b)) + b
+
+def _unpack_str(buf: bytes, offset: int) -> Tuple[str, int]:
+    (length,) = _STR.unpack_from(buf, offset)
+    offset += _STR.size
+    return buf[offset:offset + length].decode('utf-8'), offset + length
+
+def _pack_order(order: Order) -> bytes:
+    return _ORDER.pack(
+        order.timestamp, SIDE_CODES[order.side], STATUS_CODES[order.status],
+        order.price, order.size, order.usd_used, order.amount,
+        order.filled_size,
+    ) + _pack_str(order.id) + _pack_str(order.user) + _pack_str(
+        order.client_oid or '')
+
+def _unpack_order(buf: bytes, offset: int) -> Tuple[dict, int]:
+    (timestamp, side, status, price, size, usd_used, amount,
+        filled_size) = _ORDER.unpack_from(buf, offset)
+    order_id, offset = _unpack_str(buf, offset + _ORDER.size)
+    user, offset = _unpack_str(buf, offset)
+    client_oid, offset = _unpack_str(buf, offset)
+    return {
+        'timestamp':timestamp,
+        'id':order_id,
+        'side':SIDES[side],
+        'price':price,
+        'size':size,
+        'usd_used':usd_used,
+        'amount':amount,
+        'status':STATUSES[status],
+        'filled_size':filled_size,
+        'user':user,
+        'client_oid':client_oid or None,
+    }, offset
+
+def _pack_orders(orders: List[Order]) -> bytes:
+    return _LEN.pack(len(orders)) + b''.join(map(_pack_order, orders))
+
+def _unpack_orders(buf: bytes, offset: int) -> Tuple[List[dict], int]:
+    (count,) = _LEN.unpack_from(buf, offset)
+    offset += _LEN.size
+    orders = []
+    for i in range(count):
+        order, offset = _unpack_order(buf, offset)
+        orders.append(order)
+    return orders, offset
+
+def _pack_fill(fill: Fill) -> bytes:
+    return (_FILL.pack(fill.filled_size, fill.price) + _pack_str(fill.fill_id)
+        + _pack_str(fill.buy_id) + _pack_str(fill.sell_id))
+
+def _unpack_fills(buf: bytes, offset: int) -> Tuple[List[dict], int]:
+    (count,) = _LEN.unpack_from(buf, offset)
+    offset += _LEN.size
+    fills = []
+    for i in range(count):
+        filled_size, price = _FILL.unpack_from(buf, offset)
+        fill_id, offset = _unpack_str(buf, offset + _FILL.size)
+        buy_id, offset = _unpack_str(buf, offset)
+        sell_id, offset = _unpack_str(buf, offset)
+        fills.append({
+            'fill_id':fill_id,
+            'filled_size':filled_size,
+            'price':price,
+            'buy_id':buy_id,
+            'sell_id':sell_id,
+        })
+    return fills, offset
+
+def _is_req_id(req_id: Any) -> bool:
+    return isinstance(req_id, int) and 0 < req_id <= MAX_REQ_ID
+
+def _json_command(msg: dict) -> bytes:
+    """JSON fallback for a command. Cents/Units params are sent as decimal
+    strings, since the exchange reads plain JSON numbers as USD/crypto.
+    """
+    params = msg.get('params')
+    if params:
+        plain = {}
+        for key, value in params.items():
+            if isinstance(value, Cents):
+                value = from_cents(value)
+            elif isinstance(value, Units):
+                value = from_units(value)
+            plain[key] = value
+        msg = dict(msg, params=plain)
+    return json_frame(jencode(msg))
+
+def encode_command(msg: dict) -> bytes:
+    """Client side: {'cmd':..., 'params':{...}, 'req_id':...,
+    'session':...} to a frame. Params can be decimal strings or Cents/Units.
+    req_id and session are optional.
+    """
+    session = msg.get('session')
+    if session is not None:
+        if not isinstance(session, str) or set(msg) - {'cmd', 'params',
+                'req_id', 'session'}:
+            return _json_command(msg)
+        msg = {key:value for key, value in msg.items() if key != 'session'}
+        return (bytes((KIND_SESSION,)) + _pack_str(session)
+            + encode_command(msg))
+    if set(msg) - {'cmd', 'params', 'req_id'}:
+        return _json_command(msg)
+    cmd = msg['cmd']
+    params = msg.get('params') or {}
+    code = CMD_CODES.get(cmd)
+    keys = set(params)
+    req_id = msg.get('req_id')
+    if req_id is not None and not _is_req_id(req_id):
+        return _json_command(msg)
+    req_id = req_id or 0
+    client_oid = params.get('client_oid')
+    if client_oid is not None:
+        if not isinstance(client_oid, str) or not client_oid:
+            return _json_command(msg)
+        keys.discard('client_oid')
+        client_oid = client_oid.encode('utf-8')
+    else:
+        client_oid = b''
+    if cmd in ('buy', 'sell') and keys == {'price', 'size'}:
+        return _CMD_PRICE_SIZE.pack(
+            KIND_CMD, code, req_id, to_cents(params['price']),
+            to_units(params['size'])
+        ) + client_oid
+    if cmd == 'buy_market' and keys == {'amount'}:
+        return _CMD_AMOUNT.pack(
+            KIND_CMD, code, req_id, to_cents(params['amount'])
+        ) + client_oid
+    if cmd == 'sell_market' and keys == {'amount'}:
+        return _CMD_AMOUNT.pack(
+            KIND_CMD, code, req_id, to_units(params['amount'])
+        ) + client_oid
+    if client_oid:
+        return _json_command(msg)
+    if cmd == 'cancel' and keys == {'order_id'}:
+        return (_CMD.pack(KIND_CMD, code, req_id)
+            + params['order_id'].encode('utf-8'))
+    if cmd in BARE_CMDS and not keys:
+        return _CMD.pack(KIND_CMD, code, req_id)
+    return _json_command(msg)
+
+def decode_command(frame: bytes) -> dict:
+    """Server side: a frame to {'cmd':..., 'params':{...}}. Prices and sizes
+    come back as Cents/Units, which the exchange commands accept as is.
+    """
+    kind = frame[0]
+    if kind == KIND_SESSION:
+        session, offset = _unpack_str(frame, 1)
+        data = decode_command(frame[offset:])
+        data['session'] = session
+        return data
+    if kind == KIND_JSON:
+        return json.loads(frame[1:])
+    if kind != KIND_CMD:
+        raise ValueError('Not a command frame: %d' % (kind))
+    _, code, req_id = _CMD.unpack_from(frame)
+    cmd = CMDS[code]
+    client_oid = None
+    if cmd in ('buy', 'sell'):
+        price, size = _CMD_PRICE_SIZE.unpack_from(frame)[3:]
+        params = {'price':Cents(price), 'size':Units(size)}
+        client_oid = frame[_CMD_PRICE_SIZE.size:]
+    elif cmd == 'buy_market':
+        params = {'amount':Cents(_CMD_AMOUNT.unpack_from(frame)[3])}
+        client_oid = frame[_CMD_AMOUNT.size:]
+    elif cmd == 'sell_market':
+        params = {'amount':Units(_CMD_AMOUNT.unpack_from(frame)[3])}
+        client_oid = frame[_CMD_AMOUNT.size:]
+    elif cmd == 'cancel':
+        params = {'order_id':frame[_CMD.size:].decode('utf-8')}
+    else:
+        params = {}
+    if client_oid:
+        params['client_oid'] = client_oid.decode('utf-8')
+    data = {'cmd':cmd, 'params':params}
+    if req_id:
+        data['req_id'] = req_id
+    return data
+
+def encode_response(status: bool, msg: str, data: Any = None) -> bytes:
+    """Server side counterpart of util.cmd_fmt()"""
+    try:
+        data_type, payload = _pack_data(data)
+    except struct.error:
+        # A value out of the layout's range, send the data as JSON
+        data_type, payload = DATA_JSON, jencode(data).encode('utf-8')
+    return (_RESPONSE.pack(KIND_RESPONSE, int(bool(status)), data_type, 0)
+        + _pack_str(msg) + payload)
+
+def _pack_data(data: Any) -> Tuple[int, bytes]:
+    if data is None:
+        return DATA_NONE, b''
+    if isinstance(data, Order):
+        return DATA_ORDER, _pack_order(data)
+    if isinstance(data, Wallet):
+        return DATA_WALLET, _WALLET.pack(data.usd, data.crypto)
+    if isinstance(data, Decimal):
+        # The market price
+        return DATA_PRICE, _INT.pack(to_cents(data))
+    if (isinstance(data, list) and
+            all(isinstance(order, Order) for order in data)):
+        return DATA_ORDERS, _pack_orders(data)
+    if (isinstance(data, list) and
+            all(isinstance(fill, Fill) for fill in data)):
+        return DATA_FILLS, _LEN.pack(len(data)) + b''.join(map(_pack_fill, data))
+    if isinstance(data, dict) and set(data) == {'maker', 'market'}:
+        return (DATA_ORDER_SETS,
+            _pack_orders(data['maker']) + _pack_orders(data['market']))
+    if (isinstance(data, list) and data and
+            all(isinstance(result, dict) and
+                set(result) == {'status', 'message', 'data'}
+                    for result in data)):
+        # Batch results, each packed like a response of its own
+        return DATA_RESULTS, _LEN.pack(len(data)) + b''.join(
+            map(_pack_result, data))
+    return DATA_JSON, jencode(data).encode('utf-8')
+
+def _pack_result(result: dict) -> bytes:
+    data_type, payload = _pack_data(result['data'])
+    return (bytes((int(bool(result['status'])), data_type))
+        + _pack_str(result['message']) + _LEN.pack(len(payload)) + payload)
+
+def _unpack_results(buf: bytes, offset: int) -> List[dict]:
+    (count,) = _LEN.unpack_from(buf, offset)
+    offset += _LEN.size
+    results = []
+    for i in range(count):
+        status, data_type = buf[offset], buf[offset + 1]
+        msg, offset = _unpack_str(buf, offset + 2)
+        (length,) = _LEN.unpack_from(buf, offset)
+        offset += _LEN.size
+        payload = buf[offset:offset + length]
+        offset += length
+        results.append({
+            'status':bool(status), 'message':msg,
+            'data':_unpack_data(data_type, payload, 0),
+        })
+    return results
+
+def set_req_id(frame: bytes, req_id: Any) -> bytes:
+    """Server side: tag an encoded response with the request's req_id.
+    Binary req_ids must be unsigned 32 bit ints, others are not echoed.
+    """
+    if not _is_req_id(req_id):
+        return frame
+    return frame[:3] + _REQ_ID.pack(req_id) + frame[_RESPONSE.size:]
+
+def decode_response(frame: bytes) -> Tuple[bool, str, Any, Optional[int]]:
+    """Client side: a frame to (status, message, data, req_id)"""
+    kind = frame[0]
+    if kind == KIND_JSON:
+        j = json.loads(frame[1:])
+        return j['status'], j['message'], j['data'], j.get('req_id')
+    _, status, data_type, req_id = _RESPONSE.unpack_from(frame)
+    msg, offset = _unpack_str(frame, _RESPONSE.size)
+    data = _unpack_data(data_type, frame, offset)
+    return bool(status), msg, data, req_id or None
+
+def _unpack_data(data_type: int, buf: bytes, offset: int) -> Any:
+    if data_type == DATA_NONE:
+        data = None
+    elif data_type == DATA_ORDER:
+        data = _unpack_order(buf, offset)[0]
+    elif data_type == DATA_WALLET:
+        usd, crypto = _WALLET.unpack_from(buf, offset)
+        data = {'usd':usd, 'crypto':crypto}
+    elif data_type == DATA_PRICE:
+        data = _INT.unpack_from(buf, offset)[0]
+    elif data_type == DATA_ORDERS:
+        data = _unpack_orders(buf, offset)[0]
+    elif data_type == DATA_FILLS:
+        data = _unpack_fills(buf, offset)[0]
+    elif data_type == DATA_ORDER_SETS:
+        maker, offset = _unpack_orders(buf, offset)
+        market, offset = _unpack_orders(buf, offset)
+        data = {'maker':maker, 'market':market}
+    elif data_type == DATA_RESULTS:
+        data = _unpack_results(buf, offset)
+    else:
+        data = json.loads(buf[offset:])
+    return data
+
+def encode_event(data: dict) -> Optional[bytes]:
+    """Server side: a feed event to a frame, or None if the event type has no
+    fixed layout (send json_frame() of the JSON message instead).
+    """
+    event_type = data['type']
+    code = EVENT_CODES.get(event_type)
+    if code is None:
+        return None
+    header = _EVENT.pack(KIND_EVENT, code, data.get('seq') or 0)
+    message = data['message']
+    if event_type == 'cancel':
+        return header + _pack_str(message) + _pack_str(
+            data.get('client_oid') or '')
+    if event_type == 'match':
+        return (header + _MATCH.pack(message.size, message.price)
+            + _pack_str(message.buy_id) + _pack_str(message.sell_id))
+    if event_type == 'l2':
+        return header + _LEVEL.pack(
+            message.seq, SIDE_CODES[message.side], message.price, message.size
+        )
+    if event_type == 'price':
+        return header + _INT.pack(to_cents(message))
+    return header + _pack_order(message)
+
+def _decode_event(frame: bytes) -> dict:
+    _, code, seq = _EVENT.unpack_from(frame)
+    event_type = EVENTS[code]
+    offset = _EVENT.size
+    client_oid = None
+    if event_type == 'cancel':
+        message, offset = _unpack_str(frame, offset)
+        client_oid = _unpack_str(frame, offset)[0]
+    elif event_type == 'match':
+        size, price = _MATCH.unpack_from(frame, offset)
+        buy_id, offset = _unpack_str(frame, offset + _MATCH.size)
+        sell_id, offset = _unpack_str(frame, offset)
+        message = {
+            'size':size, 'price':price, 'buy_id':buy_id, 'sell_id':sell_id
+        }
+    elif event_type == 'l2':
+        l2_seq, side, price, size = _LEVEL.unpack_from(frame, offset)
+        message = {
+            'seq':l2_seq, 'side':SIDES[side], 'price':price, 'size':size
+        }
+    elif event_type == 'price':
+        (message,) = _INT.unpack_from(frame, offset)
+    else:
+        message = _unpack_order(frame, offset)[0]
+    data = {'type':event_type, 'message':message}
+    if client_oid:
+        data['client_oid'] = client_oid
+    data['seq'] = seq
+    return data
+
+def split_batch(frame: bytes) -> List[bytes]:
+    """The frames in a coalesced (batch) frame, without decoding them"""
+    frames = []
+    offset = 1
+    while offset < len(frame):
+        (length,) = _LEN.unpack_from(frame, offset)
+        offset += _LEN.size
+        frames.append(frame[offset:offset + length])
+        offset += length
+    return frames
+
+def peek_event(frame: bytes) -> Tuple[Optional[str], Optional[int]]:
+    """(event type, seq) of a KIND_EVENT frame without decoding the rest.
+    (None, None) for other frames.
+    """
+    if frame[0] != KIND_EVENT:
+        return None, None
+    _, code, seq = _EVENT.unpack_from(frame)
+    return EVENTS[code], seq
+
+def peek_level(frame: bytes) -> Tuple[str, int]:
+    """(side, price) of an l2 event frame without decoding the rest"""
+    _, side, price, _ = _LEVEL.unpack_from(frame, _EVENT.size)
+    return SIDES[side], price
+
+def decode_event(frame: bytes) -> Any:
+    """Client side: a feed frame to an event dict, or a list of them for a
+    coalesced (batch) frame.
+    """
+    kind = frame[0]
+    if kind == KIND_JSON:
+        return json.loads(frame[1:])
+    if kind == KIND_EVENT:
+        return _decode_event(frame)
+    if kind != KIND_BATCH:
+        raise ValueError('Not an event frame: %d' % (kind))
+    return [decode_event(x) for x in split_batch(frame)]
@@ -1,12 +1,14 @@
 import asyncio
-import websockets
 import sys
+from cxgame.client import CxFeedReader
 
-async def feed():
-    async with websockets.connect('ws://mtingers.com:9876') as websocket:
-        while 1:
-            response = await websocket.recv()
-            print(response)
+async def feed(topics=None):
+    # Only receive these topics (e.g. trades, orders, chat, info, admin)
+    async for event in CxFeedReader('ws://mtingers.com:9876', topics=topics):
+        if event.type == 'match':
+            print('trade', event.seq, event.price, event.size)
+        else:
+            print(event)
 
 if __name__ == '__main__':
-    asyncio.get_event_loop().run_until_complete(feed())
+    asyncio.get_event_loop().run_until_complete(feed(sys.argv[1:]))